@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the constant per-file overhead of the rule lookups in filecheck.py.
+
+The legacy implementation (bound-method dictionaries built in
+File.__init__, linear scans of Config.malicious_exts and of the subtype
+lists) is reproduced here and compared with the compiled Ruleset, on the
+same File objects:
+
+    PYTHONPATH=. python benchmarks/dispatch_overhead.py --files 2000
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from filecheck.filecheck import Config, File, ruleset
+
+SUBTYPES = ('pdf', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'msword', 'zip',
+            'x-dosexec', 'octet-stream', 'x-unknown')
+EXTENSIONS = ('.pdf', '.xlsx', '.doc', '.zip', '.exe', '.bin', '.txt', '.unknown')
+
+
+def legacy_method_dicts(file: File):
+    """The three dispatch dictionaries File.__init__ used to build for each file."""
+    subtypes_apps = (
+        (Config.mimes_office, file._winoffice),
+        (Config.mimes_ooxml, file._ooxml),
+        (Config.mimes_rtf, file.text),
+        (Config.mimes_libreoffice, file._libreoffice),
+        (Config.mimes_pdf, file._pdf),
+        (Config.mimes_xml, file.text),
+        (Config.mimes_csv, file.text),
+        (Config.mimes_ms, file._executables),
+        (Config.mimes_compressed, file._archive),
+        (Config.mimes_data, file._binary_app),
+        (Config.mimes_audio, file.audio)
+    )
+    app_subtype_methods = {}
+    for list_of_subtypes, method in subtypes_apps:
+        for subtype in list_of_subtypes:
+            app_subtype_methods[subtype] = method
+    metadata_mimetype_methods = {}
+    for list_of_subtypes, method in ((Config.mimes_exif, file._metadata_exif), (Config.mimes_png, file._metadata_png)):
+        for subtype in list_of_subtypes:
+            metadata_mimetype_methods[subtype] = method
+    mime_processing_options = {
+        'text': file.text, 'audio': file.audio, 'image': file.image, 'video': file.video,
+        'application': file.application, 'example': file.example, 'message': file.message,
+        'model': file.model, 'multipart': file.multipart, 'inode': file.inode,
+    }
+    return app_subtype_methods, metadata_mimetype_methods, mime_processing_options
+
+
+def legacy_lookups(file: File, extension: str, subtype: str):
+    app_subtype_methods, _, mime_processing_options = legacy_method_dicts(file)
+    mime_processing_options.get('application')
+    extension in Config.malicious_exts
+    for partial_subtype, method in app_subtype_methods.items():
+        if partial_subtype in subtype:
+            break
+
+
+def compiled_lookups(file: File, extension: str, subtype: str):
+    getattr(file, file.mime_processing_options.get('application', 'unknown'))
+    extension in ruleset.malicious_exts
+    ruleset.app_method(subtype)
+
+
+def run(lookups, files, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for i, file in enumerate(files):
+            lookups(file, EXTENSIONS[i % len(EXTENSIONS)], SUBTYPES[i % len(SUBTYPES)])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000, help='Number of files')
+    parser.add_argument('--rounds', type=int, default=10, help='Number of passes over the files')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src_path = Path(tmp) / 'file.txt'
+        src_path.write_bytes(b'benchmark')
+        files = [File(src_path, Path(tmp) / 'dst' / 'file.txt') for _ in range(args.files)]
+        nb_lookups = args.files * args.rounds
+        for name, lookups in (('legacy', legacy_lookups), ('compiled', compiled_lookups)):
+            elapsed = run(lookups, files, args.rounds)
+            print(f'{name:10} {elapsed:8.3f}s  {elapsed / nb_lookups * 1e6:8.2f}us per file')
+
+
+if __name__ == '__main__':
+    main()
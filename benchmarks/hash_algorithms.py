@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the hash algorithms of kittengroomer.helpers on typical key content.
+
+Two workloads are measured for each algorithm available (the xxh* ones
+need xxhash to be installed):
+- the TOCTOU samples: thousands of blocks of 16 to 128 bytes, hashed one
+  by one as _compute_random_hashes does;
+- whole files of a few sizes, hashed from disk with hash_file.
+
+    PYTHONPATH=. python benchmarks/hash_algorithms.py --sizes 4096,1048576,67108864
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from kittengroomer.helpers import HASH_ALGORITHMS, hash_file, new_hash
+
+
+def bench_samples(algorithm: str, blocks) -> float:
+    """Return the mean time to hash one sampled block."""
+    start = time.perf_counter()
+    for block in blocks:
+        sample_hash = new_hash(algorithm)
+        sample_hash.update(block)
+        sample_hash.hexdigest()
+    return (time.perf_counter() - start) / len(blocks)
+
+
+def bench_file(algorithm: str, path: Path, rounds: int) -> float:
+    """Return the hashing throughput of the file at `path` in MB/s (the file is in the page cache)."""
+    hash_file(path, algorithm)  # warm the page cache
+    start = time.perf_counter()
+    for _ in range(rounds):
+        hash_file(path, algorithm)
+    elapsed = time.perf_counter() - start
+    return path.stat().st_size * rounds / elapsed / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=str, default='4096,1048576,33554432',
+                        help='Comma separated list of file sizes in bytes')
+    parser.add_argument('--samples', type=int, default=20000, help='Number of sampled blocks')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of times each file is hashed')
+    args = parser.parse_args()
+
+    blocks = [os.urandom(random.randint(16, 128)) for _ in range(args.samples)]
+    sizes = [int(size) for size in args.sizes.split(',')]
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for size in sizes:
+            path = Path(tmp) / f'file_{size}.bin'
+            path.write_bytes(os.urandom(size))
+            paths.append(path)
+        header = f"{'algorithm':10} {'sample':>10}" + ''.join(f' {size:>12}B' for size in sizes)
+        print(header)
+        for algorithm in sorted(HASH_ALGORITHMS):
+            sample_time = bench_samples(algorithm, blocks)
+            rates = [bench_file(algorithm, path, args.rounds) for path in paths]
+            print(f'{algorithm:10} {sample_time * 1e6:8.2f}us' + ''.join(f' {rate:>8.1f} MB/s' for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
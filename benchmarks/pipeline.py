@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of KittenGroomerFileCheck.run on synthetic source keys.
+
+Each scenario generates a source tree in a temporary directory, grooms it
+to another temporary directory and reports the number of files per second,
+MB/s (size of the source tree), peak RSS and the time spent in each
+mimetype handler. The results can be written as JSON to be compared
+between releases:
+
+    PYTHONPATH=. python benchmarks/pipeline.py --output before.json
+    PYTHONPATH=. python benchmarks/pipeline.py --scenarios small_text,images --scale 0.1
+
+The per-handler times are only collected in the main process, so they are
+left out when running with --workers or --pipeline.
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict
+
+from PIL import Image  # type: ignore
+
+from filecheck.filecheck import File, KittenGroomerFileCheck, ruleset
+
+
+def make_small_text(root: Path, scale: float):
+    """Many small text files spread over a few directories."""
+    for i in range(int(2000 * scale) or 1):
+        dir_path = root / f'dir_{i % 20}'
+        dir_path.mkdir(exist_ok=True)
+        (dir_path / f'file_{i}.txt').write_text(f'Line {i}\n' * random.randint(1, 50))
+
+
+def make_deep_tree(root: Path, scale: float):
+    """A few files in each directory of a deeply nested tree."""
+    dir_path = root
+    for depth in range(int(60 * scale) or 1):
+        dir_path = dir_path / f'level_{depth}'
+        dir_path.mkdir()
+        for i in range(3):
+            (dir_path / f'file_{i}.txt').write_text(f'Depth {depth}\n')
+
+
+def _pdf_bytes(size: int) -> bytes:
+    """A minimal valid PDF, padded to about `size` bytes with a content stream."""
+    stream = b'% padding\n' * (size // 10)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R >>',
+        b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream',
+    ]
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f'{number} 0 obj\n'.encode() + obj + b'\nendobj\n')
+    xref = out.tell()
+    out.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode())
+    for offset in offsets:
+        out.write(f'{offset:010} 00000 n \n'.encode())
+    out.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+    return out.getvalue()
+
+
+def make_large_pdfs(root: Path, scale: float):
+    """A few PDFs of several MB."""
+    for i in range(int(10 * scale) or 1):
+        (root / f'document_{i}.pdf').write_bytes(_pdf_bytes(5 * 1024 * 1024))
+
+
+def _docx_bytes() -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml',
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                      '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                      '<Default Extension="xml" ContentType="application/xml"/>'
+                      '<Override PartName="/word/document.xml" ContentType='
+                      '"application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                      '</Types>')
+        docx.writestr('_rels/.rels',
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                      '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                      'relationships/officeDocument" Target="word/document.xml"/></Relationships>')
+        docx.writestr('word/document.xml',
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                      '<w:body>' + '<w:p><w:r><w:t>Benchmark</w:t></w:r></w:p>' * 500 + '</w:body></w:document>')
+    return out.getvalue()
+
+
+def make_office_docs(root: Path, scale: float):
+    """Word documents (OOXML)."""
+    data = _docx_bytes()
+    for i in range(int(200 * scale) or 1):
+        (root / f'document_{i}.docx').write_bytes(data)
+
+
+def make_nested_archives(root: Path, scale: float):
+    """Zip archives containing text files and a tar.gz of text files."""
+    for i in range(int(20 * scale) or 1):
+        inner = io.BytesIO()
+        with tarfile.open(fileobj=inner, mode='w:gz') as tar:
+            for j in range(20):
+                data = f'Inner file {j}\n'.encode() * 100
+                info = tarfile.TarInfo(f'inner_{j}.txt')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        with zipfile.ZipFile(root / f'archive_{i}.zip', 'w', zipfile.ZIP_DEFLATED) as archive:
+            for j in range(20):
+                archive.writestr(f'outer_{j}.txt', f'Outer file {j}\n' * 100)
+            archive.writestr('nested/inner.tar.gz', inner.getvalue())
+
+
+def make_images(root: Path, scale: float):
+    """Large noisy PNG and JPEG images."""
+    for i in range(int(6 * scale) or 1):
+        img = Image.frombytes('RGB', (3000, 2000), os.urandom(3000 * 2000 * 3))
+        img.save(root / f'image_{i}.png')
+        img.save(root / f'image_{i}.jpg', quality=90)
+
+
+SCENARIOS: Dict[str, Callable[[Path, float], None]] = {
+    'small_text': make_small_text,
+    'deep_tree': make_deep_tree,
+    'large_pdfs': make_large_pdfs,
+    'office_docs': make_office_docs,
+    'nested_archives': make_nested_archives,
+    'images': make_images,
+}
+
+
+class HandlerTimer(object):
+    """Wrap the mimetype handlers of File to add up the time spent in each of them."""
+
+    def __init__(self):
+        self.times: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._originals: Dict[str, Callable] = {}
+
+    def _handler_names(self):
+        names = set(File.mime_processing_options.values())
+        names.update(ruleset.app_subtype_methods.values())
+        names.update(ruleset.metadata_mimetype_methods.values())
+        return sorted(names)
+
+    def _wrap(self, name: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                # Nested handlers (application -> _pdf) are counted in both
+                self.times[name] += time.perf_counter() - start
+                self.calls[name] += 1
+        return timed
+
+    def __enter__(self):
+        for name in self._handler_names():
+            self._originals[name] = getattr(File, name)
+            setattr(File, name, self._wrap(name, self._originals[name]))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for name, method in self._originals.items():
+            setattr(File, name, method)
+        self._originals = {}
+
+
+def tree_stats(root: Path):
+    nb_files = 0
+    total_size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            nb_files += 1
+            total_size += os.path.getsize(os.path.join(dirpath, filename))
+    return nb_files, total_size
+
+
+def peak_rss() -> int:
+    """Peak resident set size in bytes, of this process and of its waited-for children."""
+    # ru_maxrss is in KiB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def run_scenario(name: str, scale: float, workers: int, pipeline: bool=False) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        src_path = Path(tmp) / 'src'
+        dst_path = Path(tmp) / 'dst'
+        src_path.mkdir()
+        dst_path.mkdir()
+        SCENARIOS[name](src_path, scale)
+        nb_files, total_size = tree_stats(src_path)
+        timer = HandlerTimer()
+        with open(os.devnull, 'w') as devnull, timer if workers == 1 and not pipeline else contextlib.nullcontext():
+            stdout = sys.stdout
+            sys.stdout = devnull  # the groomer prints skipped files
+            start = time.perf_counter()
+            try:
+                with KittenGroomerFileCheck(src_path, dst_path, workers=workers, pipeline=pipeline) as groomer:
+                    groomer.run()
+            finally:
+                sys.stdout = stdout
+            elapsed = time.perf_counter() - start
+        shutil.rmtree(dst_path)
+    return {
+        'files': nb_files,
+        'bytes': total_size,
+        'seconds': elapsed,
+        'files_per_second': nb_files / elapsed,
+        'mb_per_second': total_size / elapsed / 1024 / 1024,
+        'handlers': {handler: {'seconds': timer.times[handler], 'calls': timer.calls[handler]}
+                     for handler in sorted(timer.times)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                        help='Comma separated list of scenarios, among: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier of the number of files generated')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes used by the groomer')
+    parser.add_argument('--pipeline', action='store_true', help='Run the groomer with its staged pipeline')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated content')
+    parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = {'python': sys.version.split()[0], 'workers': args.workers, 'pipeline': args.pipeline, 'scale': args.scale, 'scenarios': {}}
+    for name in args.scenarios.split(','):
+        result = run_scenario(name, args.scale, args.workers, args.pipeline)
+        results['scenarios'][name] = result
+        print(f"{name:16} {result['files']:6} files {result['seconds']:8.2f}s "
+              f"{result['files_per_second']:9.1f} files/s {result['mb_per_second']:8.2f} MB/s")
+    # Peak RSS is only known for the whole run, scenarios are not isolated from each other
+    results['peak_rss'] = peak_rss()
+    print(f"peak RSS: {results['peak_rss'] / 1024 / 1024:.1f} MB")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
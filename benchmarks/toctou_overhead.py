@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the per-file overhead of the TOCTOU hash sampling in filecheck.py.
+
+The legacy implementation (one open() and one random sleep per sampled
+block, then one open() of the copy per block) is reproduced here so both
+can be compared on the same files, copy included:
+
+    PYTHONPATH=. python benchmarks/toctou_overhead.py --files 20 --size 65536
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from filecheck.filecheck import File
+
+
+def legacy_compute_random_hashes(file: File):
+    """_compute_random_hashes as it was before the sleeps were removed."""
+    file.random_hashes = []
+    if file.size < 64:
+        file.block_length = file.size
+    elif file.size < 128:
+        file.block_length = random.randint(16, file.size)
+    else:
+        file.block_length = random.randint(16, 128)
+    for i in range(random.randint(3, 6)):
+        start_pos = random.randint(0, file.size - file.block_length)
+        with open(file.src_path, 'rb') as f:
+            f.seek(start_pos)
+            hashed = hashlib.sha256(f.read(file.block_length)).hexdigest()
+            file.random_hashes.append((start_pos, hashed))
+            time.sleep(random.uniform(0.1, 0.5))
+
+
+def legacy_validate_random_hashes(file: File) -> bool:
+    for start_pos, hashed_src in file.random_hashes:
+        with open(file.dst_path, 'rb') as f:
+            f.seek(start_pos)
+            if hashlib.sha256(f.read(file.block_length)).hexdigest() != hashed_src:
+                return False
+    return True
+
+
+def make_files(directory: Path, count: int, size: int):
+    for i in range(count):
+        with open(directory / f'file_{i}.bin', 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def run(src_dir: Path, dst_dir: Path, legacy: bool) -> float:
+    """Return the mean time spent sampling, copying and validating one file."""
+    elapsed = 0.0
+    paths = sorted(src_dir.iterdir())
+    for path in paths:
+        file = File(path, dst_dir / path.name)
+        start = time.perf_counter()
+        if legacy:
+            legacy_compute_random_hashes(file)
+            shutil.copy(path, file.dst_path)
+            assert legacy_validate_random_hashes(file)
+        else:
+            file._compute_random_hashes()
+            file.safe_copy()
+            assert file._validate_random_hashes()
+        elapsed += time.perf_counter() - start
+    return elapsed / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=10, help='Number of files to sample')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='Size of each file in bytes')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        src_dir = Path(tmp) / 'src'
+        dst_dir = Path(tmp) / 'dst'
+        src_dir.mkdir()
+        dst_dir.mkdir()
+        make_files(src_dir, args.files, args.size)
+        before = run(src_dir, dst_dir, legacy=True)
+        after = run(src_dir, dst_dir, legacy=False)
+    print(f'{args.files} files of {args.size} bytes')
+    print(f'before (random sleeps): {before * 1000:10.3f} ms/file')
+    print(f'after:                  {after * 1000:10.3f} ms/file')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,30 @@ import mimetypes
 import shlex
 import subprocess
 import zipfile
+import tarfile
+import gzip
+import bz2
+import lzma
+import tempfile
+import io
+import multiprocessing
+import resource
 import argparse
+import asyncio
+import itertools
 import random
 import shutil
 import time
+import copy
 import hashlib
+import json
+import csv
+import sqlite3
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.connection import Connection
 from pathlib import Path
-from typing import Dict, List, Tuple, Callable, Optional, Union
+from typing import BinaryIO, Deque, Dict, FrozenSet, Iterator, List, Set, TextIO, Tuple, Callable, Optional, Union, cast
 
 import oletools.oleid  # type: ignore
 import olefile  # type: ignore
@@ -22,6 +39,9 @@ from PIL import Image  # type: ignore
 from pdfid import PDFiD, cPDFiD  # type: ignore
 
 from kittengroomer import FileBase, KittenGroomerBase, Logging
+from kittengroomer.helpers import (COPY_BUFFER_SIZE, HashingReader, HashingWriter, ImplementationRequired,
+                                   KittenGroomerError, forget_dirs, hash_file, make_dirs, new_hash,
+                                   sync_filesystem)
 
 
 class Config:
@@ -134,10 +154,495 @@ class Config:
                                     '.keynote': 'application/vnd.apple.keynote'  # ,'application/zip')
                                     }
 
+    # INTEGRITY
+    # Hash of the blocks sampled to check that a file did not change between
+    # its analysis and its copy, see kittengroomer.helpers.HASH_ALGORITHMS.
+    # Only has to be fast, the whole files are hashed with sha256 for the logs.
+    sample_hash_algorithm: str = 'blake2b'
+    # Files of these maintypes, passed through without being read by their
+    # handler, are copied by the kernel (copy_file_range or sendfile) from
+    # this size on. They are not hashed: no sha256 in the logs.
+    zero_copy_maintypes: Tuple[str, ...] = ('audio', 'video')
+    zero_copy_min_size: int = 64 * 1024 * 1024
+
+    # DURABILITY
+    # When the destination is written to disk: 'none' leaves it to the
+    # system, 'file' waits for each copied file and journal entry to be on
+    # disk, 'final' syncs the destination filesystem once at the end of the run.
+    durability: str = 'final'
+
+    # LOGGING
+    # The log file is kept open for the whole run and flushed every
+    # `log_flush_lines` lines, every `log_flush_interval` seconds and on close.
+    log_flush_lines: int = 100
+    log_flush_interval: float = 5.0
+    # Log files written to the logs directory, among 'text' (circlean_log.txt),
+    # 'jsonl' (circlean_log.jsonl) and 'csv' (circlean_log.csv)
+    log_formats: Tuple[str, ...] = ('text',)
+
+    # PIPELINE
+    # With KittenGroomerFileCheck(pipeline=True), the files are enumerated,
+    # checked, copied and logged by concurrent stages connected by queues
+    # holding at most `pipeline_queue_depth` files each.
+    pipeline_queue_depth: int = 32
+    pipeline_copy_threads: int = 2
+
+    # INCREMENTAL
+    # With KittenGroomerFileCheck(incremental=True), hash the unchanged files
+    # again and compare them with the previous run instead of trusting their
+    # size, mtime and inode.
+    incremental_verify: bool = False
+
+    # ARCHIVES
+    # Directory where archives are unpacked before their content is checked,
+    # None for the default temporary directory of the system.
+    archive_tmp_dir: Optional[str] = None
+    # Budgets for a single archive, checked from the archive headers before
+    # unpacking and enforced while unpacking. Archives going over are marked
+    # dangerous and their content is not processed.
+    archive_max_size: int = 2 * 1024 ** 3  # total uncompressed bytes
+    archive_max_ratio: float = 100.0  # uncompressed size / archive size, past the first MiB
+    archive_max_members: int = 10000
+    archive_max_seconds: float = 300.0
+
+    # SANDBOX
+    # When set, the mimetype handlers run in a separate worker process with
+    # these limits. Files going over are marked dangerous.
+    handler_timeout: Optional[float] = None  # wall-clock seconds per file
+    handler_max_memory: Optional[int] = None  # bytes the worker can grow by, on top of what it inherits
+
+    # METADATA
+    # Format of the files the image metadata is extracted to:
+    # 'text' (<file>.metadata.txt) or 'jsonl' (<file>.metadata.jsonl, one JSON object per tag)
+    metadata_format: str = 'text'
+    # EXIF parsing with exifread. `exif_details` parses the maker notes,
+    # `exif_stop_tag` stops the parsing once that tag is found ('UNDEF' for
+    # never) and `exif_xmp` looks for XMP data in the whole file.
+    exif_details: bool = True
+    exif_stop_tag: str = 'UNDEF'
+    exif_xmp: bool = False
+    # Files with more EXIF tags, or needing more bytes read to get them,
+    # are marked dangerous.
+    exif_max_tags: int = 2000
+    exif_max_bytes: int = 4 * 1024 * 1024
+
+    # IMAGES
+    # Images are decoded and re-encoded to the destination. Images that would
+    # need more memory than that (the decoded pixels and their copy) are not
+    # converted and are marked dangerous.
+    image_max_memory: int = 1024 ** 3
+
+    # VERDICT CACHE
+    # Maximum number of verdicts kept by VerdictCache, least recently used are evicted first
+    verdict_cache_max_entries: int = 100000
+
 
 SEVENZ_PATH = '/usr/bin/7z'
 
 
+class Ruleset(object):
+    """
+    Lookup tables compiled once from Config.
+
+    Extensions and mimetypes are kept in frozensets, and the handler names
+    for the partial matches on the subtype are memoized per subtype, in the
+    same order as the tuples in Config. current_ruleset() compiles them
+    again when the Config values they come from changed.
+    """
+
+    # Config attributes the tables are compiled from
+    config_attributes: Tuple[str, ...] = (
+        'mimes_ooxml', 'mimes_office', 'mimes_libreoffice', 'mimes_rtf', 'mimes_pdf', 'mimes_xml', 'mimes_csv',
+        'mimes_ms', 'mimes_compressed', 'mimes_data', 'mimes_audio', 'mimes_exif', 'mimes_png', 'mimes_metadata',
+        'aliases', 'malicious_exts',
+    )
+
+    def __init__(self):
+        # Copy of the Config values, the dicts can be changed in place
+        self.config: Tuple = tuple(copy.deepcopy(getattr(Config, name)) for name in self.config_attributes)
+        self.malicious_exts: FrozenSet[str] = frozenset(Config.malicious_exts)
+        self.metadata_mimetypes: FrozenSet[str] = frozenset(Config.mimes_metadata)
+        self.app_subtype_methods: Dict[str, str] = self._make_method_dict((
+            (Config.mimes_office, '_winoffice'),
+            (Config.mimes_ooxml, '_ooxml'),
+            (Config.mimes_rtf, 'text'),
+            (Config.mimes_libreoffice, '_libreoffice'),
+            (Config.mimes_pdf, '_pdf'),
+            (Config.mimes_xml, 'text'),
+            (Config.mimes_csv, 'text'),
+            (Config.mimes_ms, '_executables'),
+            (Config.mimes_compressed, '_archive'),
+            (Config.mimes_data, '_binary_app'),
+            (Config.mimes_audio, 'audio')
+        ))
+        self.metadata_mimetype_methods: Dict[str, str] = self._make_method_dict((
+            (Config.mimes_exif, '_metadata_exif'),
+            (Config.mimes_png, '_metadata_png'),
+        ))
+        # Checked in this order by File.text
+        self.text_subtype_kinds: Tuple[Tuple[Tuple[str, ...], str], ...] = (
+            (Config.mimes_rtf, 'rtf'),
+            (Config.mimes_ooxml, 'ooxml'),
+            (Config.mimes_csv, 'csv'),
+        )
+        self._app_method_cache: Dict[str, Optional[str]] = {}
+        self._text_kind_cache: Dict[str, Optional[str]] = {}
+
+        # Extension <-> mimetype index, gives the same answers as
+        # mimetypes.guess_type and mimetypes.guess_all_extensions (strict=False)
+        self.known_extensions: FrozenSet[str] = frozenset(mimetypes.types_map)
+        self._mimetype_by_ext: Dict[str, str] = {**mimetypes.common_types, **mimetypes.types_map}
+        # guess_type looks further than the last suffix for these
+        self._compound_suffixes: FrozenSet[str] = frozenset(mimetypes.suffix_map) | frozenset(mimetypes.encodings_map)
+        self._expected_mimetypes_cache: Dict[str, List[Optional[str]]] = {}
+        self._expected_extensions_cache: Dict[str, List[str]] = {}
+
+    def is_current(self) -> bool:
+        """True if Config did not change since the tables were compiled."""
+        return self.config == tuple(getattr(Config, name) for name in self.config_attributes)
+
+    def _make_method_dict(self, list_of_tuples: Tuple) -> Dict[str, str]:
+        """Returns a dictionary with mimetype: method name pairs."""
+        dict_to_return = {}
+        for list_of_subtypes, method in list_of_tuples:
+            for subtype in list_of_subtypes:
+                dict_to_return[subtype] = method
+        return dict_to_return
+
+    def app_method(self, subtype: str) -> Optional[str]:
+        """Name of the File method processing an application/`subtype` file, None if unknown."""
+        try:
+            return self._app_method_cache[subtype]
+        except KeyError:
+            pass
+        method = None
+        for partial_subtype, method_name in self.app_subtype_methods.items():
+            if partial_subtype in subtype:  # checking for partial matches
+                method = method_name
+                break
+        self._app_method_cache[subtype] = method
+        return method
+
+    def expected_mimetypes(self, path: Path) -> Tuple[List[Optional[str]], Optional[str]]:
+        """
+        Mimetypes expected for the extension of `path` and its encoding.
+
+        Same as mimetypes.guess_type(str(path), strict=False) followed by
+        the lookup of the aliases.
+        """
+        suffix = path.suffix
+        path_str = str(path)
+        if suffix in self._compound_suffixes or suffix.lower() in self._compound_suffixes or ':' in path_str:
+            # .tar.gz, .tgz, data: urls..., rare enough not to be indexed
+            expected_mimetype, encoding = mimetypes.guess_type(path_str, strict=False)
+            return self._with_aliases(expected_mimetype), encoding
+        ext = suffix.lower()
+        try:
+            return self._expected_mimetypes_cache[ext], None
+        except KeyError:
+            pass
+        expected_mimetypes = self._with_aliases(self._mimetype_by_ext.get(ext))
+        self._expected_mimetypes_cache[ext] = expected_mimetypes
+        return expected_mimetypes, None
+
+    def _aliases(self, mimetype: Optional[str]) -> List[str]:
+        """The aliases of `mimetype` in Config.aliases, as a list."""
+        alias = Config.aliases.get(mimetype) if mimetype is not None else None
+        if alias is None:
+            return []
+        if isinstance(alias, list):
+            return alias
+        return [alias]
+
+    def _with_aliases(self, expected_mimetype: Optional[str]) -> List[Optional[str]]:
+        expected_mimetypes: List[Optional[str]] = [expected_mimetype]
+        expected_mimetypes += self._aliases(expected_mimetype)
+        return expected_mimetypes
+
+    def expected_extensions(self, mimetype: str) -> List[str]:
+        """Extensions expected for `mimetype` and its alias, as returned by mimetypes.guess_all_extensions."""
+        try:
+            return self._expected_extensions_cache[mimetype]
+        except KeyError:
+            pass
+        expected_extensions: List[str] = []
+        for alias in self._aliases(mimetype) or [mimetype]:
+            expected_extensions += mimetypes.guess_all_extensions(alias, strict=False)
+            for alias_alias in self._aliases(alias):
+                expected_extensions += mimetypes.guess_all_extensions(alias_alias, strict=False)
+        self._expected_extensions_cache[mimetype] = expected_extensions
+        return expected_extensions
+
+    def text_kind(self, subtype: str) -> Optional[str]:
+        """'rtf', 'ooxml' or 'csv' if a text/`subtype` file is one of those, else None."""
+        try:
+            return self._text_kind_cache[subtype]
+        except KeyError:
+            pass
+        kind = None
+        for partial_subtypes, candidate in self.text_subtype_kinds:
+            if any(partial_subtype in subtype for partial_subtype in partial_subtypes):
+                kind = candidate
+                break
+        self._text_kind_cache[subtype] = kind
+        return kind
+
+
+ruleset = Ruleset()
+
+
+def compile_ruleset() -> Ruleset:
+    """Rebuild the lookup tables used by File from the current Config."""
+    global ruleset
+    ruleset = Ruleset()
+    return ruleset
+
+
+def current_ruleset() -> Ruleset:
+    """The lookup tables used by File, rebuilt if Config changed since they were compiled."""
+    if not ruleset.is_current():
+        return compile_ruleset()
+    return ruleset
+
+
+class ArchiveBudgetExceeded(KittenGroomerError):
+    """Raised when unpacking an archive goes over one of its budgets."""
+    pass
+
+
+class ArchiveExtractor(object):
+    """
+    Unpack an archive in-process with zipfile/tarfile.
+
+    Zip and tar archives (compressed or not) and single gzip, bzip2 or xz
+    streams are read with the standard library, member by member, without
+    spawning a process. Anything else is left to 7z.
+    Member paths are sanitized so nothing is written outside of `extract_path`.
+
+    The total uncompressed size, compression ratio, member count and time
+    spent are checked against the budgets from the zip headers before
+    unpacking, and while the data is written. ArchiveBudgetExceeded is raised
+    as soon as one of them is exceeded.
+    """
+
+    compressed_streams: Dict[str, Callable] = {
+        'gzip': gzip.open,
+        'x-gzip': gzip.open,
+        'x-bzip2': bz2.open,
+        'bzip2': bz2.open,
+        'x-xz': lzma.open,
+        'xz': lzma.open,
+        'x-lzma': lzma.open,
+    }
+
+    def __init__(self, archive_path: Path, extract_path: Path, subtype: str,
+                 max_size: Optional[int]=None, max_ratio: Optional[float]=None,
+                 max_members: Optional[int]=None, max_seconds: Optional[float]=None):
+        """The budgets default to the values in Config."""
+        self.archive_path: Path = archive_path
+        self.extract_path: Path = extract_path
+        self.subtype: str = subtype
+        self.max_size: int = Config.archive_max_size if max_size is None else max_size
+        self.max_ratio: float = Config.archive_max_ratio if max_ratio is None else max_ratio
+        self.max_members: int = Config.archive_max_members if max_members is None else max_members
+        self.max_seconds: float = Config.archive_max_seconds if max_seconds is None else max_seconds
+        self.archive_size: int = os.path.getsize(archive_path)
+        self.total_size: int = 0
+        self.nb_members: int = 0
+        self._start_time: float = time.monotonic()
+
+    @property
+    def is_supported(self) -> bool:
+        """True if the archive can be unpacked without 7z."""
+        return zipfile.is_zipfile(self.archive_path) or tarfile.is_tarfile(self.archive_path) \
+            or self.subtype in self.compressed_streams
+
+    def extract(self):
+        """
+        Unpack the archive to self.extract_path.
+
+        Raises ArchiveBudgetExceeded if the archive goes over budget, other
+        exceptions on invalid or encrypted archives.
+        """
+        self._start_time = time.monotonic()
+        self.extract_path.mkdir(parents=True, exist_ok=True)
+        if zipfile.is_zipfile(self.archive_path):
+            self._extract_zip()
+        elif tarfile.is_tarfile(self.archive_path):
+            self._extract_tar()
+        else:
+            self._extract_stream()
+
+    def _member_path(self, member_name: str) -> Optional[Path]:
+        """
+        Destination of an archive member, None if it would end up outside of self.extract_path.
+
+        Members going through a symlink unpacked earlier, or replacing one,
+        are rejected: writing them would follow the symlink.
+        """
+        parts = [part for part in Path(member_name.replace('\\', '/')).parts
+                 if part not in ('', '.', '/')]
+        if not parts or '..' in parts:
+            return None
+        member_path = self.extract_path.joinpath(*parts)
+        path = member_path
+        while path != self.extract_path:
+            if os.path.islink(path):
+                return None
+            path = path.parent
+        return member_path
+
+    def check_budget(self, total_size: int, nb_members: int):
+        """Raise ArchiveBudgetExceeded if an archive of that size and member count is over budget."""
+        if total_size > self.max_size:
+            raise ArchiveBudgetExceeded(f'more than {self.max_size} bytes once unpacked')
+        if total_size > COPY_BUFFER_SIZE and total_size > self.max_ratio * max(self.archive_size, 1):
+            raise ArchiveBudgetExceeded(f'compression ratio over {self.max_ratio}')
+        if nb_members > self.max_members:
+            raise ArchiveBudgetExceeded(f'more than {self.max_members} members')
+        if time.monotonic() - self._start_time > self.max_seconds:
+            raise ArchiveBudgetExceeded(f'unpacking took more than {self.max_seconds} seconds')
+
+    def _add_member(self):
+        self.nb_members += 1
+        self.check_budget(self.total_size, self.nb_members)
+
+    def _write_member(self, fsrc, member_path: Path):
+        self._add_member()
+        member_path.parent.mkdir(parents=True, exist_ok=True)
+        # Never follow a symlink, even if one showed up since _member_path
+        fd = os.open(member_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o666)
+        with open(fd, 'wb') as fdst:
+            while True:
+                buf = fsrc.read(COPY_BUFFER_SIZE)
+                if not buf:
+                    break
+                self.total_size += len(buf)
+                self.check_budget(self.total_size, self.nb_members)
+                fdst.write(buf)
+
+    def _extract_zip(self):
+        with zipfile.ZipFile(self.archive_path) as archive:
+            infolist = archive.infolist()
+            # zipfile never returns more than the size declared in the headers
+            self.check_budget(sum(info.file_size for info in infolist), len(infolist))
+            for info in infolist:
+                member_path = self._member_path(info.filename)
+                if member_path is None:
+                    continue
+                if info.is_dir():
+                    self._add_member()
+                    member_path.mkdir(parents=True, exist_ok=True)
+                else:
+                    with archive.open(info) as fsrc:
+                        self._write_member(fsrc, member_path)
+
+    def _extract_tar(self):
+        with tarfile.open(self.archive_path, 'r:*') as archive:
+            for member in archive:
+                member_path = self._member_path(member.name)
+                if member_path is None:
+                    continue
+                if member.isdir():
+                    self._add_member()
+                    member_path.mkdir(parents=True, exist_ok=True)
+                elif member.issym():
+                    self._add_member()
+                    # Kept as a symlink, never followed: the members going through it are skipped
+                    if os.path.lexists(member_path):
+                        continue
+                    member_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.symlink(member.linkname, member_path)
+                elif member.isfile() or member.islnk():
+                    fsrc = archive.extractfile(member)
+                    if fsrc is not None:
+                        with fsrc:
+                            self._write_member(fsrc, member_path)
+                # Devices and fifos are skipped
+
+    def _extract_stream(self):
+        name = self.archive_path.name
+        stem, ext = os.path.splitext(name)
+        member_path = self.extract_path / (stem if ext else name)
+        with self.compressed_streams[self.subtype](self.archive_path, 'rb') as fsrc:
+            self._write_member(fsrc, member_path)
+
+
+class MetadataBudgetExceeded(KittenGroomerError):
+    """Raised when reading the metadata of a file goes over its budget."""
+    pass
+
+
+class BudgetedReader(io.RawIOBase):
+    """Binary file wrapper raising MetadataBudgetExceeded once more than `max_bytes` were read."""
+
+    def __init__(self, fileobj: BinaryIO, max_bytes: int):
+        super().__init__()
+        self._file = fileobj
+        self.max_bytes: int = max_bytes
+        self.bytes_read: int = 0
+        self.exceeded: bool = False
+
+    def read(self, size: Optional[int]=-1) -> bytes:
+        if size is None or size < 0:
+            size = self.max_bytes - self.bytes_read + 1
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_bytes:
+            self.exceeded = True
+            raise MetadataBudgetExceeded(f'more than {self.max_bytes} bytes read')
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int=os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+
+class MetadataWriter(object):
+    """
+    Write the metadata tags extracted from a file to a metadata file.
+
+    The file is opened once, when the first tag is written, and the tags
+    go through its buffer, as "Key: <key>\tValue: <value>" lines or as
+    JSON lines.
+    """
+
+    extensions: Dict[str, str] = {'text': '.metadata.txt', 'jsonl': '.metadata.jsonl'}
+
+    def __init__(self, path: Path, output_format: str='text'):
+        if output_format not in self.extensions:
+            raise ValueError(f'Unknown metadata format: {output_format}')
+        self.path: Path = path
+        self.output_format: str = output_format
+        self._file: Optional[TextIO] = None
+
+    def write_tag(self, key: str, value: str):
+        if self._file is None:
+            self._file = open(self.path, 'w')
+        if self.output_format == 'jsonl':
+            self._file.write(json.dumps({'key': key, 'value': value}) + '\n')
+        else:
+            self._file.write("Key: {}\tValue: {}\n".format(key, value))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class File(FileBase):
     """
     Main file object
@@ -146,48 +651,44 @@ class File(FileBase):
     filetype-specific processing methods.
     """
 
+    # Names of the methods processing each main type
+    mime_processing_options: Dict[str, str] = {
+        'text': 'text',
+        'audio': 'audio',
+        'image': 'image',
+        'video': 'video',
+        'application': 'application',
+        'example': 'example',
+        'message': 'message',
+        'model': 'model',
+        'multipart': 'multipart',
+        'inode': 'inode',
+    }
+
     def __init__(self, src_path: Path, dst_path: Path):
         super(File, self).__init__(src_path, dst_path)
         self.is_archive: bool = False
-        self.tempdir_path: Path = Path(str(self.dst_path) + '_temp')
-
-        subtypes_apps: Tuple[Tuple[Tuple[str, ...], Callable], ...] = (
-            (Config.mimes_office, self._winoffice),
-            (Config.mimes_ooxml, self._ooxml),
-            (Config.mimes_rtf, self.text),
-            (Config.mimes_libreoffice, self._libreoffice),
-            (Config.mimes_pdf, self._pdf),
-            (Config.mimes_xml, self.text),
-            (Config.mimes_csv, self.text),
-            (Config.mimes_ms, self._executables),
-            (Config.mimes_compressed, self._archive),
-            (Config.mimes_data, self._binary_app),
-            (Config.mimes_audio, self.audio)
-        )
-        self.app_subtype_methods: Dict[str, Callable] = self._make_method_dict(subtypes_apps)
-
-        types_metadata: Tuple[Tuple[Tuple[str, ...], Callable], ...] = (
-            (Config.mimes_exif, self._metadata_exif),
-            (Config.mimes_png, self._metadata_png),
-        )
-        self.metadata_mimetype_methods: Dict[str, Callable] = self._make_method_dict(types_metadata)
-
-        self.mime_processing_options: Dict[str, Callable] = {
-            'text': self.text,
-            'audio': self.audio,
-            'image': self.image,
-            'video': self.video,
-            'application': self.application,
-            'example': self.example,
-            'message': self.message,
-            'model': self.model,
-            'multipart': self.multipart,
-            'inode': self.inode,
-        }
+        self.random_hashes: List[Tuple[int, str]] = []
+        self.block_length: int = 0
+        self.checked_sha256: Optional[str] = None  # hash of the content the verdict was cached for
+        self.is_converted: bool = False  # written to the destination by its handler, see image()
+        # stage: [wall time, CPU time] in seconds, None unless enable_timings() was called
+        self.timings: Optional[Dict[str, List[float]]] = None
+        # [method, argument] for each call renaming the file, replayed from the verdict cache
+        self.renames: List[Tuple[str, Optional[str]]] = []
 
     def __repr__(self):
         return "<filecheck.File object: {{{}}}>".format(self.filename)
 
+    def make_dangerous(self, reason_string: Optional[str]=None):
+        if not self.is_dangerous:
+            self.renames.append(('make_dangerous', None))
+        super(File, self).make_dangerous(reason_string)
+
+    def force_ext(self, extension: str):
+        self.renames.append(('force_ext', extension))
+        super(File, self).force_ext(extension)
+
     def _check_extension(self):
         """
         Guess the file's mimetype based on its extension.
@@ -205,21 +706,10 @@ class File(FileBase):
                 encoding = None
                 self.mimetype = expected_mimetypes
             else:
-                expected_mimetype, encoding = mimetypes.guess_type(str(self.src_path),
-                                                                   strict=False)
-
-                expected_mimetypes = [expected_mimetype]
-                if expected_mimetype in Config.aliases:
-                    if isinstance(Config.aliases[expected_mimetype], list):
-                        expected_mimetypes += Config.aliases[expected_mimetype]
-                    else:
-                        expected_mimetypes.append(Config.aliases[expected_mimetype])
-            if (encoding is None) and (os.path.getsize(self.src_path) == 0):
-                is_empty_file = True
-            else:
-                is_empty_file = False
+                expected_mimetypes, encoding = ruleset.expected_mimetypes(self.src_path)
+            is_empty_file = encoding is None and self.size == 0
 
-            is_known_extension = self.extension in mimetypes.types_map.keys()
+            is_known_extension = self.extension in ruleset.known_extensions
             if is_known_extension and self.mimetype not in expected_mimetypes and not is_empty_file:
                 self.make_dangerous(f'Mimetype does not match expected mimetypes ({expected_mimetypes}) for this extension')
 
@@ -233,14 +723,7 @@ class File(FileBase):
         if not self.has_mimetype:
             self.make_dangerous('File has no mimetype')
         else:
-            if self.mimetype in Config.aliases:
-                mimetype = Config.aliases[self.mimetype]
-            else:
-                mimetype = self.mimetype
-            expected_extensions = mimetypes.guess_all_extensions(mimetype,
-                                                                 strict=False)
-            if mimetype in Config.aliases:
-                expected_extensions += mimetypes.guess_all_extensions(Config.aliases[mimetype], strict=False)
+            expected_extensions = ruleset.expected_extensions(self.mimetype)
             if expected_extensions:
                 if self.has_extension and self.extension not in expected_extensions:
                     self.make_dangerous(f'Extension does not match expected extensions ({expected_extensions}) for this mimetype')
@@ -267,11 +750,19 @@ class File(FileBase):
 
     def _check_malicious_exts(self):
         """Check that the file's extension isn't contained in a blacklist"""
-        if self.extension in Config.malicious_exts:
+        if self.extension in ruleset.malicious_exts:
             self.make_dangerous('Extension identifies file as potentially dangerous')
 
     def _compute_random_hashes(self):
-        """Compute a random amount of hashes at random positions in the file to ensure integrity after the copy (mitigate TOCTOU attacks)"""
+        """
+        Compute a random amount of hashes at random positions in the file to ensure integrity after the copy (mitigate TOCTOU attacks)
+
+        All the blocks are read through a single file handle, in random order,
+        or from the content read to determine the mimetype of small files.
+        The time separation between the samples comes from the rest of the
+        processing: the same blocks are captured again while the file is being
+        copied, after it has been analyzed (see _validate_random_hashes).
+        """
         if not os.path.exists(self.src_path) or os.path.isdir(self.src_path) or self.maintype == 'image':
             # Images are converted, no need to compute the hashes
             return
@@ -287,67 +778,165 @@ class File(FileBase):
                 # Get a random length between 16 and 128
                 self.block_length = random.randint(16, 128)
 
-        for i in range(random.randint(3, 6)):  # Do a random amound of read on the file (between 5 and 10)
-            start_pos = random.randint(0, self.size - self.block_length)  # Pick a random length for the hash to compute
-            with open(self.src_path, 'rb') as f:
+        # Pick a random amount of random positions for the hashes to compute (between 3 and 6)
+        positions = [random.randint(0, self.size - self.block_length) for _ in range(random.randint(3, 6))]
+        with (io.BytesIO(self.header) if self.header is not None else open(self.src_path, 'rb')) as f:
+            for start_pos in positions:
                 f.seek(start_pos)
-                hashed = hashlib.sha256(f.read(self.block_length)).hexdigest()
-                self.random_hashes.append((start_pos, hashed))
-                time.sleep(random.uniform(0.1, 0.5))  # Add a random sleep length
+                sample_hash = new_hash(Config.sample_hash_algorithm)
+                sample_hash.update(f.read(self.block_length))
+                self.random_hashes.append((start_pos, sample_hash.hexdigest()))
+
+    def _copy_sample_ranges(self) -> List[Tuple[int, int]]:
+        return [(start_pos, self.block_length) for start_pos, _ in self.random_hashes]
+
+    def _fsync_copy(self) -> bool:
+        return Config.durability == 'file'
+
+    def _zero_copy(self) -> bool:
+        # The verdict cache needs the sha256 of what is copied to match the checked content
+        return self.maintype in Config.zero_copy_maintypes and self.size >= Config.zero_copy_min_size \
+            and self.checked_sha256 is None and not self.is_dangerous
 
     def _validate_random_hashes(self) -> bool:
-        """Validate hashes computed by _compute_random_hashes"""
+        """
+        Validate hashes computed by _compute_random_hashes
+
+        Compares them with the blocks captured by safe_copy while the file was
+        being copied, so neither the source nor the copy has to be read again.
+        """
         if not os.path.exists(self.src_path) or os.path.isdir(self.src_path) or self.maintype == 'image':
             # Images are converted, we don't have to fear TOCTOU
             return True
+        if self.checked_sha256 is not None and self.checked_sha256 != self.src_sha256:
+            # The verdict came from the cache for different content
+            return False
         for start_pos, hashed_src in self.random_hashes:
-            with open(self.dst_path, 'rb') as f:
-                f.seek(start_pos)
-                hashed = hashlib.sha256(f.read(self.block_length)).hexdigest()
-                if hashed != hashed_src:
-                    # Something fucked up happened
-                    return False
+            sample_hash = new_hash(Config.sample_hash_algorithm)
+            sample_hash.update(self.copied_samples.get(start_pos, b''))
+            if sample_hash.hexdigest() != hashed_src:
+                # Something fucked up happened
+                return False
         return True
 
-    def check(self):
+    def check(self, verdict_cache: Optional['VerdictCache']=None, sandbox: Optional['HandlerSandbox']=None):
         """
         Main file processing method.
 
         First, checks for basic properties that might indicate a dangerous file.
         If the file isn't dangerous, then delegates to various helper methods
         for filetype-specific checks based on the file's mimetype.
+
+        If a `verdict_cache` is given, the result of the filetype-specific
+        checks is looked up by content hash instead of being computed again.
+        If a `sandbox` is given, they run in its worker process.
         """
+        current_ruleset()
+        self.timed('checks', self._check_properties)
+        self.timed('random_hashes', self._compute_random_hashes)
+        # Not needed anymore, keep the file small when it goes back to the main process
+        self.header = None
+
+        if not self.is_dangerous:
+            if verdict_cache is not None and self._is_cacheable:
+                self.timed('handler', self._process_mimetype_cached, verdict_cache, sandbox)
+            else:
+                self.timed('handler', self._process_mimetype, sandbox)
+
+    def get_all_props(self) -> dict:
+        """Return a dict containing all stored properties of this file, with its timings."""
+        props = super(File, self).get_all_props()
+        props['timings'] = self.timings
+        return props
+
+    def _check_properties(self):
         # Any of these methods can call make_dangerous():
         self._check_malicious_exts()
         self._check_mimetype()
         self._check_extension()
         self._check_filename()  # can mutate self.filename
-        self._compute_random_hashes()
 
-        if not self.is_dangerous:
-            self.mime_processing_options.get(self.maintype, self.unknown)()
+    def enable_timings(self):
+        """Record the wall and CPU time spent in each processing stage in self.timings."""
+        if self.timings is None:
+            self.timings = {}
 
-    # ##### Helper functions #####
-    def _make_method_dict(self, list_of_tuples: Tuple) -> Dict[str, Callable]:
-        """Returns a dictionary with mimetype: method pairs."""
-        dict_to_return = {}
-        for list_of_subtypes, method in list_of_tuples:
-            for subtype in list_of_subtypes:
-                dict_to_return[subtype] = method
-        return dict_to_return
+    def add_timing(self, stage: str, wall_time: float, cpu_time: float):
+        """Add `wall_time` and `cpu_time` to `stage`, unless timings are disabled."""
+        if self.timings is None:
+            return
+        timing = self.timings.setdefault(stage, [0., 0.])
+        timing[0] += wall_time
+        timing[1] += cpu_time
+
+    def timed(self, stage: str, method: Callable, *args):
+        """Call `method` with `args`, adding the time it took to `stage` if timings are enabled."""
+        if self.timings is None:
+            return method(*args)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            return method(*args)
+        finally:
+            self.add_timing(stage, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    def _process_mimetype(self, sandbox: Optional['HandlerSandbox']=None):
+        """Run the handler for the file's mimetype, in `sandbox` if given."""
+        if sandbox is not None:
+            sandbox.run(self)
+        else:
+            method_name = 'unknown'
+            if self.maintype is not None:
+                method_name = self.mime_processing_options.get(self.maintype, method_name)
+            getattr(self, method_name)()
 
+    @property
+    def _is_cacheable(self) -> bool:
+        """
+        True if the result of the mimetype handler only depends on the content.
+
+        Images are converted and their metadata extracted on the destination
+        key, archives are unpacked: the handler has to run for them.
+        """
+        return self.maintype not in ('image', 'inode') and self.size > 0 \
+            and not self.is_symlink and not any(subtype in (self.subtype or '') for subtype in Config.mimes_compressed)
+
+    def _process_mimetype_cached(self, verdict_cache: 'VerdictCache', sandbox: Optional['HandlerSandbox']=None):
+        """Run the mimetype handler, or replay its verdict from `verdict_cache`."""
+        self.checked_sha256 = self.src_sha256 = Logging.computehash(self.src_path)
+        verdict = verdict_cache.get(self.checked_sha256, self.mimetype)
+        if verdict is not None:
+            # In the original order: force_ext depends on the name of this file
+            for method_name, argument in verdict['renames']:
+                if method_name == 'make_dangerous':
+                    self.make_dangerous()
+                else:
+                    self.force_ext(argument)
+            for description in verdict['descriptions']:
+                self.add_description(description)
+            self.should_copy = verdict['should_copy']
+            return
+        nb_renames = len(self.renames)
+        nb_descriptions = len(self._description_string)
+        self._process_mimetype(sandbox)
+        if not self._errors and not self.is_archive:
+            verdict_cache.put(self.checked_sha256, self.mimetype, {
+                'renames': self.renames[nb_renames:],
+                'descriptions': self._description_string[nb_descriptions:],
+                'should_copy': self.should_copy,
+            })
+
+    # ##### Helper functions #####
     @property
     def has_metadata(self) -> bool:
         """True if filetype typically contains metadata, else False."""
-        if self.mimetype in Config.mimes_metadata:
+        if self.mimetype in ruleset.metadata_mimetypes:
             return True
         return False
 
-    def make_tempdir(self) -> Path:
-        """Make a temporary directory at self.tempdir_path."""
-        if not self.tempdir_path.exists():
-            self.tempdir_path.mkdir(parents=True)
-        return self.tempdir_path
+    def discard_output(self):
+        """Remove what a handler may have written to the destination, after it failed."""
+        if not self.is_converted and os.path.lexists(self.dst_path):
+            os.unlink(self.dst_path)
 
     #######################
     # ##### Discarded mimetypes, reason in the docstring ######
@@ -387,29 +976,27 @@ class File(FileBase):
     # ##### Files that will be converted ######
     def text(self):
         """Process an rtf, ooxml, or plaintext file."""
-        for mt in Config.mimes_rtf:
-            if mt in self.subtype:
-                self.add_description('Rich Text (rtf) file')
-                self.force_ext('.txt')
-                return
-        for mt in Config.mimes_ooxml:
-            if mt in self.subtype:
-                self._ooxml()
-                return
-        for mt in Config.mimes_csv:
-            if mt in self.subtype:
-                self.add_description('CSV file')
-                return
+        kind = ruleset.text_kind(self.subtype)
+        if kind == 'rtf':
+            self.add_description('Rich Text (rtf) file')
+            self.force_ext('.txt')
+            return
+        if kind == 'ooxml':
+            self._ooxml()
+            return
+        if kind == 'csv':
+            self.add_description('CSV file')
+            return
         self.add_description('Plain text file')
         self.force_ext('.txt')
 
     def application(self):
         """Process an application specific file according to its subtype."""
-        for subtype, method in self.app_subtype_methods.items():
-            if subtype in self.subtype:  # checking for partial matches
-                method()
-                return
-        self._unknown_app()  # if none of the methods match
+        method_name = ruleset.app_method(self.subtype)
+        if method_name is not None:
+            getattr(self, method_name)()
+        else:
+            self._unknown_app()  # if none of the methods match
 
     def _executables(self):
         """Process an executable file."""
@@ -524,21 +1111,29 @@ class File(FileBase):
 
     #######################
     # Metadata extractors
-    def _metadata_exif(self, metadata_file_path) -> bool:
-        """Read exif metadata from a jpg or tiff file using exifread."""
-        # TODO: can we shorten this method somehow?
+    def _metadata_exif(self, metadata_file: MetadataWriter) -> bool:
+        """
+        Read exif metadata from a jpg or tiff file using exifread.
+
+        The file is parsed once, reading at most Config.exif_max_bytes and
+        returning at most Config.exif_max_tags tags, see Config.
+        """
         with open(self.src_path, 'rb') as img:
-            tags = None
+            reader = BudgetedReader(img, Config.exif_max_bytes)
             try:
-                tags = exifread.process_file(img, debug=True)
+                tags = exifread.process_file(cast(BinaryIO, reader), stop_tag=Config.exif_stop_tag,
+                                             details=Config.exif_details, debug=Config.exif_xmp)
             except Exception as e:
-                self.add_error(e, "Error while trying to grab full metadata for file {}; retrying for partial data.".format(self.src_path))
-            if tags is None:
-                try:
-                    tags = exifread.process_file(img, debug=True)
-                except Exception as e:
+                if not reader.exceeded:
                     self.add_error(e, "Failed to get any metadata for file {}.".format(self.src_path))
                     return False
+            if reader.exceeded:
+                # exifread swallows some exceptions, the budget may have been hit while reading a maker note
+                self.make_dangerous(f'EXIF metadata over budget (more than {Config.exif_max_bytes} bytes)')
+                return False
+            if len(tags) > Config.exif_max_tags:
+                self.make_dangerous(f'EXIF metadata over budget (more than {Config.exif_max_tags} tags)')
+                return False
             for tag in sorted(tags.keys()):
                 # These tags are long and obnoxious/binary so we don't add them
                 if tag not in ('JPEGThumbnail', 'TIFFThumbnail'):
@@ -547,13 +1142,12 @@ class File(FileBase):
                     if len(tag_string) > 25 and tag_string.endswith(", ... ]"):
                         tag_value = tags[tag].values
                         tag_string = str(tag_value)
-                    with open(metadata_file_path, 'w+') as metadata_file:
-                        metadata_file.write("Key: {}\tValue: {}\n".format(tag, tag_string))
+                    metadata_file.write_tag(tag, tag_string)
             # TODO: how do we want to log metadata?
             self.set_property('metadata', 'exif')
         return True
 
-    def _metadata_png(self, metadata_file_path) -> bool:
+    def _metadata_png(self, metadata_file: MetadataWriter) -> bool:
         """Extract metadata from a png file using PIL/Pillow."""
         warnings.simplefilter('error', Image.DecompressionBombWarning)
         try:
@@ -561,8 +1155,7 @@ class File(FileBase):
                 for tag in sorted(img.info.keys()):
                     # These are long and obnoxious/binary
                     if tag not in ('icc_profile'):
-                        with open(metadata_file_path, 'w+') as metadata_file:
-                            metadata_file.write("Key: {}\tValue: {}\n".format(tag, img.info[tag]))
+                        metadata_file.write_tag(str(tag), str(img.info[tag]))
                 # LOG: handle metadata
                 self.set_property('metadata', 'png')
             return True
@@ -574,12 +1167,15 @@ class File(FileBase):
 
     def extract_metadata(self):
         """Create metadata file and call correct metadata extraction method."""
-        metadata_file_path = self.create_metadata_file(".metadata.txt")
         mt = self.mimetype
-        metadata_processing_method = self.metadata_mimetype_methods.get(mt)
+        metadata_processing_method = ruleset.metadata_mimetype_methods.get(mt)
         if metadata_processing_method:
-            # TODO: should we return metadata and write it here instead of in processing method?
-            metadata_processing_method(metadata_file_path)
+            metadata_file_path = self.create_metadata_file(MetadataWriter.extensions[Config.metadata_format])
+            if not metadata_file_path:
+                return
+            with MetadataWriter(metadata_file_path, Config.metadata_format) as metadata_file:
+                # TODO: should we return metadata and write it here instead of in processing method?
+                getattr(self, metadata_processing_method)(metadata_file)
 
     #######################
     # ##### Media - audio and video aren't converted ######
@@ -602,67 +1198,93 @@ class File(FileBase):
         Process an image.
 
         Extracts metadata to dest key using self.extract_metada() if metadata
-        is present. Creates a temporary directory on dest key, opens the image
-        using PIL.Image, saves it to the temporary directory, and copies it to
-        the destination.
+        is present. Opens the image using PIL.Image, copies its pixels to a
+        new image and re-encodes it straight to the destination, hashing the
+        source and the output on the way. The image is decoded in full:
+        Config.image_max_memory does not lower the memory used, it rejects the
+        images whose two decoded copies would need more.
         """
         if self.has_metadata:
             self.extract_metadata()
-        tempdir_path = self.make_tempdir()
-        tempfile_path = tempdir_path / self.filename
         warnings.simplefilter('error', Image.DecompressionBombWarning)
+        dst_path = self.dst_path
         try:  # Do image conversions
-            with Image.open(self.src_path) as img_in:
-                with Image.frombytes(img_in.mode, img_in.size, img_in.tobytes()) as img_out:
-                    img_out.save(tempfile_path)
-                self.src_path = tempfile_path
+            with HashingReader(self.src_path) as src, Image.open(src) as img_in:
+                width, height = img_in.size
+                # Pillow stores a pixel on 1 byte for the 1, L and P modes, 4 bytes for the others
+                row_size = width * (1 if img_in.mode in ('1', 'L', 'P') else 4)
+                if 2 * row_size * height > Config.image_max_memory:
+                    self.make_dangerous('Image too large to be converted')
+                    return
+                # Same as saving to a path: the format comes from the extension
+                image_format = Image.registered_extensions().get(os.path.splitext(self.filename)[1].lower())
+                if image_format is None:
+                    raise ValueError(f'unknown file extension: {self.filename}')
+                img_in.load()
+                # Only the pixels are copied
+                with Image.new(img_in.mode, img_in.size) as img_out:
+                    img_out.paste(img_in)
+                    make_dirs(self.dst_dir)
+                    with HashingWriter(dst_path) as writer:
+                        img_out.save(writer, format=image_format)
+                self.dst_sha256 = writer.hexdigest()
+                self.src_sha256 = src.hexdigest()
+                self.is_converted = True
         except Exception as e:  # Catch decompression bombs
             # TODO: change this from all Exceptions to specific DecompressionBombWarning
             self.add_error(e, "Caught exception (possible decompression bomb?) while translating file {}.".format(self.src_path))
             self.make_dangerous('Image file containing decompression bomb')
+            if os.path.lexists(dst_path):
+                os.unlink(dst_path)
         if not self.is_dangerous:
             self.add_description('Image file')
 
 
-class GroomerLogger(object):
-    """Groomer logging interface."""
+class LogSink(object):
+    """
+    Destination of the records of GroomerLogger.
 
-    def __init__(self, src_root_path: Path, dst_root_path: Path, debug: bool=False):
-        self._src_root_path: Path = src_root_path
-        self._dst_root_path: Path = dst_root_path
-        self._log_dir_path: Path = self._make_log_dir(dst_root_path)
-        self.log_path: Path = self._log_dir_path / 'circlean_log.txt'
-        self._add_root_dir(src_root_path)
-        if debug:
-            self.log_debug_err: Path = self._log_dir_path / 'debug_stderr.log'
-            self.log_debug_out: Path = self._log_dir_path / 'debug_stdout.log'
-        else:
-            self.log_debug_err = Path(os.devnull)
-            self.log_debug_out = Path(os.devnull)
+    Subclass and implement add_root, add_file and add_dir to write the log
+    in another format, then pass an instance to GroomerLogger.add_sink.
+    """
 
-    def _make_log_dir(self, root_dir_path: Path) -> Path:
-        """Create the directory in the dest dir that will hold the logs"""
-        log_dir_path = root_dir_path / 'logs'
-        if os.path.exists(log_dir_path):
-            shutil.rmtree(log_dir_path)
-        os.makedirs(log_dir_path)
-        return log_dir_path
+    def add_root(self, root_path: Path):
+        """Called once with the root directory of the source key."""
+        raise ImplementationRequired('Please implement add_root.')
 
-    def _add_root_dir(self, root_path: Path):
+    def add_file(self, file_path: Path, file_props: dict, relative_path: str, depth: int):
+        """Called for each file, with the properties from File.get_all_props."""
+        raise ImplementationRequired('Please implement add_file.')
+
+    def add_dir(self, dir_path: Path, relative_path: str, depth: int):
+        """Called for each directory."""
+        raise ImplementationRequired('Please implement add_dir.')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TextLogSink(LogSink):
+    """The human readable tree written to circlean_log.txt."""
+
+    def __init__(self, log_path: Path):
+        self.log_path: Path = log_path
+        self._log_file = open(log_path, mode='ab')
+
+    def add_root(self, root_path: Path):
         """Add the root directory to the log"""
         dirname = os.path.split(root_path)[1] + '/'
-        with open(self.log_path, mode='ab') as lf:
-            lf.write(bytes(dirname, 'utf-8'))
-            lf.write(b'\n')
+        self._log_file.write(bytes(dirname, 'utf-8'))
+        self._log_file.write(b'\n')
 
-    def add_file(self, file_path: Path, file_props: dict, in_tempdir: bool=False):
-        """Add a file to the log. Takes a path and a dict of file properties."""
-        depth = self._get_path_depth(str(file_path))
-        try:
-            file_hash = Logging.computehash(file_path)[:6]
-        except IsADirectoryError:
-            file_hash = 'directory'
-        except FileNotFoundError:
+    def add_file(self, file_path: Path, file_props: dict, relative_path: str, depth: int):
+        if file_props.get('sha256'):
+            # Computed while the file was processed, files that were not read in full are not hashed
+            file_hash = file_props['sha256'][:6]
+        else:
             file_hash = '------'
         if file_props['is_symlink']:
             symlink_template = "+- NOT COPIED: symbolic link to {name} ({sha_hash})"
@@ -694,16 +1316,12 @@ class GroomerLogger(object):
         if file_props['errors']:
             error_string = ', '.join([str(key) for key in file_props['errors']])
             log_string += (' Errors: ' + error_string)
-        if in_tempdir:
-            depth -= 1
         self._write_line_to_log(log_string, depth)
 
-    def add_dir(self, dir_path: Path):
-        """Add a directory to the log"""
-        path_depth = self._get_path_depth(str(dir_path))
+    def add_dir(self, dir_path: Path, relative_path: str, depth: int):
         dirname = os.path.split(str(dir_path))[1] + '/'
         log_line = '+- ' + dirname
-        self._write_line_to_log(log_line, path_depth)
+        self._write_line_to_log(log_line, depth)
 
     def _format_file_size(self, size: int) -> str:
         """Returns a string with the file size and appropriate unit"""
@@ -715,16 +1333,6 @@ class GroomerLogger(object):
                 file_size = int(file_size / 1024)
         return str(int(file_size)) + 'GB'
 
-    def _get_path_depth(self, path: str) -> int:
-        """Returns the relative path depth compared to root directory"""
-        if str(self._dst_root_path) in path:
-            base_path = str(self._dst_root_path)
-        elif str(self._src_root_path) in path:
-            base_path = str(self._src_root_path)
-        relpath = os.path.relpath(path, base_path)
-        path_depth = relpath.count(os.path.sep)
-        return path_depth
-
     def _write_line_to_log(self, line: str, indentation_depth: int):
         """
         Write a line to the log
@@ -734,38 +1342,759 @@ class GroomerLogger(object):
         padding = b'   '
         padding += b'|  ' * indentation_depth
         line_bytes = os.fsencode(line)
-        with open(self.log_path, mode='ab') as lf:
-            lf.write(padding)
-            lf.write(line_bytes)
-            lf.write(b'\n')
+        self._log_file.write(padding + line_bytes + b'\n')
+
+    def flush(self):
+        if not self._log_file.closed:
+            self._log_file.flush()
+
+    def close(self):
+        if not self._log_file.closed:
+            self._log_file.close()
+
+
+def _jsonable_props(file_props: dict) -> dict:
+    """The properties of a file with the errors and paths turned into strings."""
+    record = dict(file_props)
+    record['filepath'] = str(file_props['filepath'])
+    if file_props.get('symlink_path') is not None:
+        record['symlink_path'] = str(file_props['symlink_path'])
+    record['errors'] = [{'error': repr(error), 'info': info} for error, info in file_props['errors'].items()]
+    return record
+
+
+class JsonLinesLogSink(LogSink):
+    """One JSON object per file and directory, written to circlean_log.jsonl."""
+
+    def __init__(self, log_path: Path):
+        self.log_path: Path = log_path
+        self._log_file = open(log_path, mode='a', encoding='utf-8')
+
+    def _write_record(self, record: dict):
+        self._log_file.write(json.dumps(record, default=str) + '\n')
+
+    def add_root(self, root_path: Path):
+        self._write_record({'type': 'root', 'path': str(root_path)})
+
+    def add_file(self, file_path: Path, file_props: dict, relative_path: str, depth: int):
+        record = {'type': 'file', 'path': relative_path, 'depth': depth}
+        record.update(_jsonable_props(file_props))
+        self._write_record(record)
+
+    def add_dir(self, dir_path: Path, relative_path: str, depth: int):
+        self._write_record({'type': 'dir', 'path': relative_path, 'depth': depth})
+
+    def flush(self):
+        if not self._log_file.closed:
+            self._log_file.flush()
+
+    def close(self):
+        if not self._log_file.closed:
+            self._log_file.close()
+
+
+class CsvLogSink(LogSink):
+    """One row per file and directory, written to circlean_log.csv."""
+
+    columns: Tuple[str, ...] = ('type', 'path', 'depth', 'filename', 'file_size', 'mimetype', 'extension',
+                                'is_dangerous', 'is_symlink', 'symlink_path', 'copied', 'sha256',
+                                'src_sha256', 'dst_sha256',
+                                'description_string', 'errors', 'timings')
+
+    def __init__(self, log_path: Path):
+        self.log_path: Path = log_path
+        write_header = not log_path.exists() or log_path.stat().st_size == 0
+        self._log_file = open(log_path, mode='a', encoding='utf-8', newline='')
+        self._writer = csv.DictWriter(self._log_file, fieldnames=self.columns, extrasaction='ignore')
+        if write_header:
+            self._writer.writeheader()
+
+    def add_root(self, root_path: Path):
+        self._writer.writerow({'type': 'root', 'path': str(root_path)})
+
+    def add_file(self, file_path: Path, file_props: dict, relative_path: str, depth: int):
+        row = _jsonable_props(file_props)
+        row.update({'type': 'file', 'path': relative_path, 'depth': depth})
+        row['errors'] = '; '.join(f"{error['error']}: {error['info']}" for error in row['errors'])
+        if row.get('timings') is not None:
+            row['timings'] = json.dumps(row['timings'])
+        self._writer.writerow(row)
+
+    def add_dir(self, dir_path: Path, relative_path: str, depth: int):
+        self._writer.writerow({'type': 'dir', 'path': relative_path, 'depth': depth})
+
+    def flush(self):
+        if not self._log_file.closed:
+            self._log_file.flush()
+
+    def close(self):
+        if not self._log_file.closed:
+            self._log_file.close()
+
+
+class GroomerLogger(object):
+    """
+    Groomer logging interface.
+
+    Passes each file and directory to the log sinks: the text tree in
+    circlean_log.txt, and optionally JSON lines and CSV (see
+    Config.log_formats) or custom LogSink subclasses.
+    """
+
+    sink_classes: Dict[str, Tuple[Callable[[Path], LogSink], str]] = {
+        'text': (TextLogSink, 'circlean_log.txt'),
+        'jsonl': (JsonLinesLogSink, 'circlean_log.jsonl'),
+        'csv': (CsvLogSink, 'circlean_log.csv'),
+    }
+
+    def __init__(self, src_root_path: Path, dst_root_path: Path, debug: bool=False,
+                 flush_lines: Optional[int]=None, flush_interval: Optional[float]=None,
+                 log_formats: Optional[Tuple[str, ...]]=None, keep_files: Tuple[str, ...]=()):
+        self._src_root_path: Path = src_root_path
+        self._dst_root_path: Path = dst_root_path
+        self._log_dir_path: Path = self._make_log_dir(dst_root_path, keep_files)
+        self.log_path: Path = self._log_dir_path / 'circlean_log.txt'
+        self._extra_root_paths: List[Path] = []
+        self._flush_lines: int = Config.log_flush_lines if flush_lines is None else flush_lines
+        self._flush_interval: float = Config.log_flush_interval if flush_interval is None else flush_interval
+        self._lines_since_flush = 0
+        self._last_flush = time.monotonic()
+        self.sinks: List[LogSink] = []
+        for log_format in (Config.log_formats if log_formats is None else log_formats):
+            sink_class, filename = self.sink_classes[log_format]
+            self.add_sink(sink_class(self._log_dir_path / filename))
+        if debug:
+            self.log_debug_err: Path = self._log_dir_path / 'debug_stderr.log'
+            self.log_debug_out: Path = self._log_dir_path / 'debug_stdout.log'
+        else:
+            self.log_debug_err = Path(os.devnull)
+            self.log_debug_out = Path(os.devnull)
+
+    def _make_log_dir(self, root_dir_path: Path, keep_files: Tuple[str, ...]=()) -> Path:
+        """
+        Create the directory in the dest dir that will hold the logs
+
+        The logs of a previous run are removed, except for the files named
+        in `keep_files`.
+        """
+        log_dir_path = root_dir_path / 'logs'
+        if not keep_files:
+            if os.path.exists(log_dir_path):
+                shutil.rmtree(log_dir_path)
+        elif os.path.isdir(log_dir_path):
+            for entry in os.scandir(log_dir_path):
+                if entry.name in keep_files:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+        os.makedirs(log_dir_path, exist_ok=True)
+        return log_dir_path
+
+    def add_sink(self, sink: LogSink):
+        """Pass the records to `sink` too, starting with the root directory."""
+        self.sinks.append(sink)
+        sink.add_root(self._src_root_path)
+
+    def add_file(self, file_path: Path, file_props: dict, in_tempdir: bool=False):
+        """Add a file to the log. Takes a path and a dict of file properties."""
+        relative_path = self._get_relative_path(str(file_path))
+        depth = relative_path.count(os.path.sep)
+        if in_tempdir:
+            depth -= 1
+        for sink in self.sinks:
+            sink.add_file(file_path, file_props, relative_path, depth)
+        self._record_written()
+
+    def add_dir(self, dir_path: Path):
+        """Add a directory to the log"""
+        relative_path = self._get_relative_path(str(dir_path))
+        for sink in self.sinks:
+            sink.add_dir(dir_path, relative_path, relative_path.count(os.path.sep))
+        self._record_written()
+
+    def add_root(self, root_path: Path):
+        """
+        Register another directory mirroring the layout of the destination.
+
+        Used for the directories archives are unpacked to.
+        """
+        self._extra_root_paths.append(root_path)
+
+    def _get_relative_path(self, path: str) -> str:
+        """Returns the path relative to the root directory"""
+        if str(self._dst_root_path) in path:
+            base_path = str(self._dst_root_path)
+        elif str(self._src_root_path) in path:
+            base_path = str(self._src_root_path)
+        else:
+            base_path = next(str(root) for root in self._extra_root_paths if str(root) in path)
+        return os.path.relpath(path, base_path)
+
+    def _get_path_depth(self, path: str) -> int:
+        """Returns the relative path depth compared to root directory"""
+        return self._get_relative_path(path).count(os.path.sep)
+
+    def _record_written(self):
+        self._lines_since_flush += 1
+        if self._lines_since_flush >= self._flush_lines \
+                or time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the log files."""
+        for sink in self.sinks:
+            sink.flush()
+        self._lines_since_flush = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flush and close the log files."""
+        for sink in self.sinks:
+            sink.close()
+
+
+class HandlerSandbox(object):
+    """
+    Run the mimetype handlers of File.check in a separate worker process.
+
+    The worker is reused from one file to the next. The handlers can grow
+    its address space by `max_memory` bytes, on top of what the worker
+    inherits from the process that started it, and each file gets `timeout`
+    seconds of wall-clock and CPU time. If a handler goes over, crashes or raises, the
+    worker is killed if needed, the file is marked dangerous and the next
+    file gets a new worker.
+    """
+
+    def __init__(self, timeout: Optional[float]=None, max_memory: Optional[int]=None):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self._process: Optional[multiprocessing.Process] = None
+        self._conn: Optional[Connection] = None
+
+    def _start_worker(self) -> Connection:
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_sandbox_worker, args=(child_conn, self.timeout, self.max_memory), daemon=True)
+        self._process.start()
+        child_conn.close()
+        return self._conn
+
+    def run(self, file: File):
+        """Run the mimetype handler of `file` in the worker and update `file` with the result."""
+        conn = self._conn
+        if conn is None or self._process is None or not self._process.is_alive():
+            conn = self._start_worker()
+        try:
+            conn.send(file)
+            if not conn.poll(self.timeout):
+                self.close()
+                file.add_error(TimeoutError(f'Processing took more than {self.timeout} seconds'), '')
+                file.discard_output()
+                file.make_dangerous('Processing timed out')
+                return
+            result, error = conn.recv()
+        except (EOFError, OSError) as e:
+            # The worker died: out of memory, out of CPU time or crashed
+            self.close()
+            file.add_error(e, 'Processing worker died')
+            file.discard_output()
+            file.make_dangerous('Processing failed (out of memory or CPU time?)')
+            return
+        file.__dict__.update(result.__dict__)
+        if error is not None:
+            file.add_error(error, 'Exception raised while processing file')
+            file.make_dangerous('Processing failed')
+
+    def close(self):
+        """Stop the worker process."""
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._process = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _address_space_size() -> int:
+    """Size of the address space of this process in bytes, 0 if it can't be read (not Linux)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def _sandbox_worker(conn, timeout: Optional[float], max_memory: Optional[int]):
+    """Main loop of the HandlerSandbox worker process."""
+    if max_memory is not None:
+        # RLIMIT_AS caps the whole address space, including what was inherited from the parent
+        limit = _address_space_size() + max_memory
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    while True:
+        try:
+            file = conn.recv()
+        except EOFError:
+            return
+        if timeout is not None:
+            # RLIMIT_CPU counts the whole life of the process, give this file `timeout` more seconds
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu_limit = int(usage.ru_utime + usage.ru_stime + timeout) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, resource.RLIM_INFINITY))
+        error = None
+        try:
+            file._process_mimetype()
+        except Exception as e:
+            error = e
+        conn.send((file, error))
+
+
+# Config attributes deciding the verdicts, the others (durability, logging...) do not change the rules
+RULE_CONFIG_NAMES: Tuple[str, ...] = ('malicious_exts', 'aliases', 'override_ext')
+RULE_CONFIG_PREFIXES: Tuple[str, ...] = ('mimes_', 'exif_', 'image_', 'archive_max_')
+
+
+def ruleset_version() -> str:
+    """
+    Identify the rules used by filecheck.py.
+
+    Changes whenever the rules in Config (see RULE_CONFIG_NAMES and
+    RULE_CONFIG_PREFIXES) or the filecheck.py code change, so results
+    computed with other rules are never reused.
+    """
+    config = {name: repr(value) for name, value in vars(Config).items()
+              if name in RULE_CONFIG_NAMES or name.startswith(RULE_CONFIG_PREFIXES)}
+    s = hashlib.sha256(json.dumps(config, sort_keys=True).encode())
+    with open(__file__, 'rb') as f:
+        s.update(f.read())
+    return s.hexdigest()
+
+
+class VerdictCache(object):
+    """
+    Persistent cache of the verdicts of the mimetype handlers.
+
+    Verdicts are stored in an SQLite database and keyed by the sha256 of the
+    file content, its mimetype and the ruleset version. Verdicts computed with
+    another ruleset are dropped when the cache is opened, and the least
+    recently used verdicts are evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, db_path: Path, max_entries: Optional[int]=None,
+                 ruleset: Optional[str]=None):
+        self.db_path: Path = db_path
+        self.max_entries: int = Config.verdict_cache_max_entries if max_entries is None else max_entries
+        self.ruleset: str = ruleset or ruleset_version()
+        # The cache can be shared by several worker processes
+        # Archives are processed in another thread by the pipeline, never concurrently with this one
+        self._db = sqlite3.connect(str(db_path), timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts ('
+                'sha256 TEXT NOT NULL, mimetype TEXT NOT NULL, ruleset TEXT NOT NULL, '
+                'verdict TEXT NOT NULL, last_used REAL NOT NULL, '
+                'PRIMARY KEY (sha256, mimetype, ruleset))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)')
+            self._db.execute('DELETE FROM verdicts WHERE ruleset != ?', (self.ruleset,))
+
+    def get(self, sha256: str, mimetype: str) -> Optional[dict]:
+        """Return the verdict stored for this content and mimetype, or None."""
+        key = (sha256, mimetype, self.ruleset)
+        row = self._db.execute(
+            'SELECT verdict FROM verdicts WHERE sha256 = ? AND mimetype = ? AND ruleset = ?', key).fetchone()
+        if row is None:
+            return None
+        with self._db:
+            self._db.execute(
+                'UPDATE verdicts SET last_used = ? WHERE sha256 = ? AND mimetype = ? AND ruleset = ?',
+                (time.time(),) + key)
+        return json.loads(row[0])
+
+    def put(self, sha256: str, mimetype: str, verdict: dict):
+        """Store `verdict` for this content and mimetype, evicting old verdicts if needed."""
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO verdicts (sha256, mimetype, ruleset, verdict, last_used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (sha256, mimetype, self.ruleset, json.dumps(verdict), time.time()))
+            self._db.execute(
+                'DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts '
+                'ORDER BY last_used DESC, rowid DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def close(self):
+        self._db.close()
+
+
+class ProgressJournal(object):
+    """
+    Record of the files already groomed, used to resume an interrupted run.
+
+    The journal is a JSON lines file in the log directory: a header with the
+    ruleset version, then one entry per file of the source key that was
+    logged, with its size, mtime, inode, sha256, log properties and
+    destination. When resuming, a file is skipped if its size, mtime and
+    inode did not change and its copy is still on the destination key; the
+    entries written by another ruleset are not reused. Archives are
+    processed again, their entry only records where they were unpacked.
+    Files extracted from them and files with errors are not journaled, they
+    are processed again. Only the runs started with resume or incremental keep
+    a journal, so only they can be resumed.
+
+    In incremental mode, the journal of the previous run is the index of
+    the destination: once the run is done, the copies of the files that
+    vanished from the source are removed and the journal is rewritten with
+    the files of this run only.
+    """
+
+    filename = 'progress.journal'
+
+    def __init__(self, log_dir_path: Path, src_root_path: Path, dst_root_path: Path, resume: bool=False,
+                 ruleset: Optional[str]=None):
+        self.journal_path: Path = log_dir_path / self.filename
+        self.src_root_path = src_root_path
+        self.dst_root_path = dst_root_path
+        self.ruleset: str = ruleset or ruleset_version()
+        self.entries: Dict[str, dict] = {}
+        # False if the entries were written by another ruleset
+        self.reusable = False
+        # Files of the source seen by this run
+        self.seen: Set[str] = set()
+        if resume and self.journal_path.exists() and self._load() == self.ruleset:
+            self._journal_file = open(self.journal_path, mode='a', encoding='utf-8')
+        else:
+            # The entries of another ruleset are kept in memory for the incremental mode, not in the new journal
+            self._journal_file = open(self.journal_path, mode='w', encoding='utf-8')
+            self._write_entry({'ruleset': self.ruleset})
+
+    def _load(self) -> Optional[str]:
+        """Read the entries of the journal, returns the ruleset it was written with."""
+        with open(self.journal_path, encoding='utf-8') as journal_file:
+            lines = iter(journal_file)
+            try:
+                header = json.loads(next(lines))
+            except (StopIteration, ValueError):
+                return None
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted run can be truncated
+                    break
+                self.entries[entry['path']] = entry
+        self.reusable = header.get('ruleset') == self.ruleset and bool(self.entries)
+        return header.get('ruleset')
+
+    def _write_entry(self, entry: dict):
+        self._journal_file.write(json.dumps(entry, default=str) + '\n')
+        # Every entry is worth keeping if the run is interrupted
+        self._journal_file.flush()
+        if Config.durability == 'file':
+            os.fsync(self._journal_file.fileno())
+
+    def _relative_path(self, src_path: Path) -> Optional[str]:
+        try:
+            return str(src_path.relative_to(self.src_root_path))
+        except ValueError:
+            return None
+
+    def completed(self, src_path: Path) -> Optional[dict]:
+        """The log properties of `src_path` if it was groomed by a previous run and did not change since."""
+        relative_path = self._relative_path(src_path)
+        entry = self.entries.get(relative_path) if self.reusable else None  # type: ignore
+        if entry is None or entry.get('archive'):
+            return None
+        try:
+            src_stat = os.lstat(src_path)
+            if (src_stat.st_size, src_stat.st_mtime_ns, src_stat.st_ino) != \
+                    (entry['size'], entry['mtime_ns'], entry['inode']):
+                return None
+            if entry['dst_size'] is not None \
+                    and os.lstat(self.dst_root_path / entry['dst']).st_size != entry['dst_size']:
+                return None
+            if Config.incremental_verify and entry['props']['src_sha256'] \
+                    and hash_file(src_path) != entry['props']['src_sha256']:
+                return None
+        except OSError:
+            return None
+        self.seen.add(relative_path)  # type: ignore
+        props = dict(entry['props'])
+        props['filepath'] = src_path
+        props['errors'] = {}
+        return props
+
+    def record(self, file: File):
+        """Add a file that was logged to the journal."""
+        relative_path = self._relative_path(file.src_path)
+        if relative_path is None:
+            return
+        self.seen.add(relative_path)
+        if file._errors:
+            return
+        if file.is_archive:
+            # Kept so its content is removed once it vanishes from the source
+            archive_entry: dict = {'path': relative_path, 'dst': str(file.dst_path.relative_to(self.dst_root_path)),
+                                   'dst_size': None, 'archive': True}
+            self.entries[relative_path] = archive_entry
+            self._write_entry(archive_entry)
+            return
+        try:
+            src_stat = os.lstat(file.src_path)
+            dst_size = os.lstat(file.dst_path).st_size if file.copied else None
+        except OSError:
+            return
+        props = _jsonable_props(file.get_all_props())
+        del props['filepath'], props['errors']
+        props['timings'] = None
+        entry = {
+            'path': relative_path,
+            'size': src_stat.st_size,
+            'mtime_ns': src_stat.st_mtime_ns,
+            'inode': src_stat.st_ino,
+            'dst': str(file.dst_path.relative_to(self.dst_root_path)),
+            'dst_size': dst_size,
+            'props': props,
+        }
+        previous = self.entries.get(relative_path)
+        if previous is not None and previous['dst'] != entry['dst'] and previous['dst_size'] is not None:
+            # The file changed and was copied under another name (e.g. it is dangerous now)
+            stale_path = self.dst_root_path / previous['dst']
+            if os.path.lexists(stale_path):
+                os.remove(stale_path)
+        self.entries[relative_path] = entry
+        self._write_entry(entry)
+
+    def remove_vanished(self) -> List[Path]:
+        """
+        Remove the copies of the files not seen by this run, and rewrite the journal without them.
+
+        Returns the paths removed from the destination.
+        """
+        removed = []
+        for relative_path, entry in list(self.entries.items()):
+            if relative_path in self.seen:
+                continue
+            del self.entries[relative_path]
+            dst_path = self.dst_root_path / entry['dst']
+            if entry.get('archive'):
+                # The directory it was unpacked to
+                if os.path.islink(dst_path) or not os.path.isdir(dst_path):
+                    continue
+                shutil.rmtree(dst_path)
+            else:
+                if entry['dst_size'] is None or not os.path.lexists(dst_path):
+                    continue
+                os.remove(dst_path)
+            removed.append(dst_path)
+            # Remove the directories left empty, but not the ones still on the source
+            dir_path = dst_path.parent
+            while dir_path != self.dst_root_path \
+                    and not (self.src_root_path / dir_path.relative_to(self.dst_root_path)).is_dir():
+                try:
+                    dir_path.rmdir()
+                except OSError:
+                    break
+                dir_path = dir_path.parent
+        self._journal_file.close()
+        tmp_path = self.journal_path.with_name(self.filename + '.tmp')
+        with open(tmp_path, mode='w', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps({'ruleset': self.ruleset}) + '\n')
+            for entry in self.entries.values():
+                journal_file.write(json.dumps(entry, default=str) + '\n')
+        os.replace(tmp_path, self.journal_path)
+        self._journal_file = open(self.journal_path, mode='a', encoding='utf-8')
+        return removed
+
+    def close(self):
+        self._journal_file.close()
+
+
+class StageTimer(object):
+    """
+    Aggregate the time spent in each processing stage, per mimetype.
+
+    The stages are recorded on the File objects (see File.enable_timings):
+    mimetype (stat and libmagic), checks, random_hashes, handler, copy,
+    validate and unpack for archives. The times are in seconds, CPU time is
+    the one of the process running the stage. Each callback added with
+    add_hook is called with the file, the stage, its wall time and its CPU
+    time when a file is done. The bytes written by the copy stage are added
+    up to report its throughput.
+    """
+
+    def __init__(self):
+        self.hooks: List[Callable[[File, str, float, float], None]] = []
+        # mimetype: {stage: [wall time, CPU time, number of files]}
+        self.totals: Dict[str, Dict[str, List[float]]] = {}
+        self.copied_bytes = 0
+
+    def add_hook(self, callback: Callable[[File, str, float, float], None]):
+        self.hooks.append(callback)
+
+    def record(self, file: File):
+        """Add the timings of a file that is done to the totals and pass them to the hooks."""
+        if not file.timings:
+            return
+        stages = self.totals.setdefault(str(file.mimetype), {})
+        if 'copy' in file.timings:
+            self.copied_bytes += file.copied_bytes
+        for stage, (wall_time, cpu_time) in file.timings.items():
+            total = stages.setdefault(stage, [0., 0., 0])
+            total[0] += wall_time
+            total[1] += cpu_time
+            total[2] += 1
+            for callback in self.hooks:
+                callback(file, stage, wall_time, cpu_time)
+
+    def summary(self) -> str:
+        """Totals per stage and per mimetype and stage, as text."""
+        all_stages: Dict[str, List[float]] = {}
+        for stages in self.totals.values():
+            for stage, (wall_time, cpu_time, count) in stages.items():
+                total = all_stages.setdefault(stage, [0., 0., 0])
+                total[0] += wall_time
+                total[1] += cpu_time
+                total[2] += count
+        line_template = '{:<60} {:>10.3f}s {:>10.3f}s {:>8}'
+        lines = ['{:<60} {:>11} {:>11} {:>8}'.format('stage', 'wall', 'cpu', 'files')]
+        for stage, (wall_time, cpu_time, count) in sorted(all_stages.items(), key=lambda item: -item[1][0]):
+            lines.append(line_template.format(stage, wall_time, cpu_time, int(count)))
+        if all_stages.get('copy', [0.])[0] > 0:
+            copy_rate = self.copied_bytes / all_stages['copy'][0]
+            lines.append(f'copy: {self.copied_bytes} bytes, {copy_rate / 1024 / 1024:.1f} MB/s')
+        lines.append('')
+        lines.append('{:<60} {:>11} {:>11} {:>8}'.format('mimetype: stage', 'wall', 'cpu', 'files'))
+        for mimetype, stages in sorted(self.totals.items()):
+            for stage, (wall_time, cpu_time, count) in sorted(stages.items(), key=lambda item: -item[1][0]):
+                lines.append(line_template.format(f'{mimetype}: {stage}', wall_time, cpu_time, int(count)))
+        return '\n'.join(lines) + '\n'
 
 
 class KittenGroomerFileCheck(KittenGroomerBase):
 
-    def __init__(self, root_src: str, root_dst: str, max_recursive_depth: int=2, debug: bool=False):
+    def __init__(self, root_src: str, root_dst: str, max_recursive_depth: int=2, debug: bool=False,
+                 workers: int=1, verdict_cache_path: Optional[str]=None,
+                 handler_timeout: Optional[float]=None, handler_max_memory: Optional[int]=None,
+                 timings: bool=False, log_formats: Optional[Tuple[str, ...]]=None, pipeline: bool=False,
+                 resume: bool=False, incremental: bool=False):
         super(KittenGroomerFileCheck, self).__init__(root_src, root_dst)
         self.recursive_archive_depth = 0
         self.max_recursive_depth = max_recursive_depth
-        self.logger = GroomerLogger(self.src_root_path, self.dst_root_path, debug)
+        self.workers = workers
+        self.pipeline = pipeline
+        self._executor: Optional[Executor] = None
+        self._work_root_path: Optional[Path] = None
+        self.verdict_cache: Optional[VerdictCache] = None
+        if verdict_cache_path:
+            self.verdict_cache = VerdictCache(Path(verdict_cache_path))
+        self.handler_timeout = handler_timeout if handler_timeout is not None else Config.handler_timeout
+        self.handler_max_memory = handler_max_memory if handler_max_memory is not None else Config.handler_max_memory
+        self.sandbox: Optional[HandlerSandbox] = None
+        if self.handler_timeout is not None or self.handler_max_memory is not None:
+            self.sandbox = HandlerSandbox(self.handler_timeout, self.handler_max_memory)
+        self.stage_timer: Optional[StageTimer] = StageTimer() if timings else None
+        self.logger = GroomerLogger(self.src_root_path, self.dst_root_path, debug, log_formats=log_formats,
+                                    keep_files=(ProgressJournal.filename,) if resume or incremental else ())
+        self.incremental = incremental
+        self.journal: Optional[ProgressJournal] = None
+        if resume or incremental:
+            self.journal = ProgressJournal(self.logger.log_path.parent, self.src_root_path, self.dst_root_path,
+                                           resume=True)
 
     def __repr__(self):
         return "filecheck.KittenGroomerFileCheck object: {{{}}}".format(
             os.path.basename(self.src_root_path)
         )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Flush and close the log files, the journal and the verdict cache, stop the sandbox worker."""
+        self._remove_work_root()
+        self.logger.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.verdict_cache is not None:
+            self.verdict_cache.close()
+        if self.sandbox is not None:
+            self.sandbox.close()
+
+    def add_timing_hook(self, callback: Callable[[File, str, float, float], None]):
+        """Enable the timings and call `callback` for each stage of each file, see StageTimer."""
+        if self.stage_timer is None:
+            self.stage_timer = StageTimer()
+        self.stage_timer.add_hook(callback)
+
     def process_dir(self, src_dir: Path, dst_dir: Optional[Path] = None):
         """Process a directory on the source key."""
-        for srcpath in self.list_files_dirs(src_dir):
-            if not srcpath.is_symlink() and srcpath.is_dir():
+        if self._executor is not None:
+            self._process_dir_parallel(src_dir, dst_dir)
+            return
+        for srcpath, is_dir in self.walk_files_dirs(src_dir):
+            if is_dir:
                 self.logger.add_dir(srcpath)
+                continue
+            props = self._journaled_props(srcpath)
+            if props is not None:
+                self.logger.add_file(srcpath, props)
             else:
-                if dst_dir:
-                    dstpath = dst_dir
-                else:
-                    dstpath = Path(str(srcpath).replace(str(self.src_root_path), str(self.dst_root_path)))
-                cur_file = File(srcpath, dstpath)
+                cur_file = make_file(srcpath, self._get_dst_path(srcpath, dst_dir), self.stage_timer is not None)
                 self.process_file(cur_file)
 
+    def _process_dir_parallel(self, src_dir: Path, dst_dir: Optional[Path] = None):
+        """
+        Process a directory on the source key using the worker pool.
+
+        Files are checked and copied by the workers, but their results are
+        consumed in traversal order so the log keeps the same depth-first
+        layout as a sequential run. Archives are unpacked in this process
+        once their turn comes, which keeps the recursion depth accounting
+        in one place. The files already groomed by a previous run are queued
+        with their log properties from the journal.
+        """
+        assert self._executor is not None
+        pending: Deque[Tuple[Path, Union[Future, dict, None]]] = deque()
+        max_pending = self.workers * 4
+        for srcpath, is_dir in self.walk_files_dirs(src_dir):
+            props = None if is_dir else self._journaled_props(srcpath)
+            if is_dir:
+                pending.append((srcpath, None))
+            elif props is not None:
+                pending.append((srcpath, props))
+            else:
+                future = self._executor.submit(_groom_path, srcpath, self._get_dst_path(srcpath, dst_dir),
+                                               self.stage_timer is not None)
+                pending.append((srcpath, future))
+            while len(pending) > max_pending:
+                self._finish_pending(pending.popleft())
+        while pending:
+            self._finish_pending(pending.popleft())
+
+    def _finish_pending(self, pending_item: Tuple[Path, Union[Future, dict, None]]):
+        srcpath, result = pending_item
+        if result is None:
+            self.logger.add_dir(srcpath)
+        elif isinstance(result, dict):
+            self.logger.add_file(srcpath, result)
+        else:
+            self._finish_file(result.result())
+
+    def _journaled_props(self, srcpath: Path) -> Optional[dict]:
+        """The log properties of `srcpath` if the journal says it was already groomed by a previous run."""
+        if self.journal is None or not self.journal.reusable:
+            return None
+        return self.journal.completed(srcpath)
+
+    def _get_dst_path(self, srcpath: Path, dst_dir: Optional[Path] = None) -> Path:
+        if dst_dir:
+            return dst_dir
+        return Path(str(srcpath).replace(str(self.src_root_path), str(self.dst_root_path)))
+
     def process_file(self, file: File):
         """
         Process an individual file.
@@ -773,47 +2102,92 @@ class KittenGroomerFileCheck(KittenGroomerBase):
         Check the file, handle archives using self.process_archive, copy
         the file to the destionation key, and clean up temporary directory.
         """
-        file.check()
+        groom_file(file, self.verdict_cache, self.sandbox)
+        self._finish_file(file)
+
+    def _finish_file(self, file: File):
+        """Log a file that went through `groom_file`, or unpack it if it is an archive."""
         if file.is_archive:
             self.process_archive(file)
         else:
-            if file.should_copy:
-                if file.safe_copy():
-                    file.set_property('copied', True)
-                    if not file._validate_random_hashes():
-                        # Something's fucked up.
-                        file.make_dangerous('The copied file is different from the one checked, removing.')
-                        file.dst_path.unlink()
-                else:
-                    file.set_property('copied', False)
             self.write_file_to_log(file)
-        # TODO: Can probably handle cleaning up the tempdir better
-        if hasattr(file, 'tempdir_path'):
-            self.safe_rmtree(file.tempdir_path)
+        if self.journal is not None:
+            self.journal.record(file)
+        if self.stage_timer is not None:
+            self.stage_timer.record(file)
 
     def process_archive(self, file: File):
         """
-        Unpack an archive using 7zip and process contents using process_dir.
+        Unpack an archive and process contents using process_dir.
 
         Should be given a Kittengroomer file object whose src_path points
-        to an archive.
+        to an archive. The archive is unpacked in a work directory outside of
+        the destination key, in-process when ArchiveExtractor supports it and
+        with 7zip otherwise.
         """
         self.recursive_archive_depth += 1
         if self.recursive_archive_depth >= self.max_recursive_depth:
             file.make_dangerous('Archive bomb')
         else:
-            tempdir_path = file.make_tempdir()
-            command_str = '{} -p1 x "{}" -o"{}" -bd -aoa'
-            # -p1=password, x=extract, -o=output location, -bd=no % indicator, -aoa=overwrite existing files
-            unpack_command = command_str.format(SEVENZ_PATH,
-                                                file.src_path, tempdir_path)
-            self._run_process(unpack_command)
-            self.write_file_to_log(file)
-            self.process_dir(tempdir_path, file.dst_path / file.filename)
+            tempdir_path = self._get_work_path(Path(f'{file.dst_path}_temp'))
+            extractor = ArchiveExtractor(file.src_path, tempdir_path, file.subtype or '')
+            try:
+                file.timed('unpack', self._extract_archive, file, extractor)
+            except ArchiveBudgetExceeded as e:
+                file.make_dangerous(f'Archive bomb ({e.message})')
+            if not file.is_dangerous:
+                self.process_dir(tempdir_path, file.dst_path / file.filename)
             self.safe_rmtree(tempdir_path)
+        # Only logged if it is dangerous, otherwise its content is logged instead
+        self.write_file_to_log(file)
         self.recursive_archive_depth -= 1
 
-    def _run_process(self, command_string: str, timeout: Optional[int]=None) -> bool:
+    def _extract_archive(self, file: File, extractor: ArchiveExtractor):
+        """Unpack the archive in-process if possible, with 7z otherwise."""
+        if extractor.is_supported:
+            try:
+                extractor.extract()
+                return
+            except ArchiveBudgetExceeded:
+                raise
+            except Exception as e:
+                # Encrypted or damaged archive, 7z may still get something out of it
+                file.add_error(e, 'Could not unpack {} in-process, falling back to 7z.'.format(file.src_path))
+                self.safe_rmtree(extractor.extract_path)
+        extractor.extract_path.mkdir(parents=True)
+        if not self._extract_with_7z(file.src_path, extractor.extract_path, timeout=extractor.max_seconds):
+            if time.monotonic() - extractor._start_time > extractor.max_seconds:
+                raise ArchiveBudgetExceeded(f'unpacking took more than {extractor.max_seconds} seconds')
+        # 7z can't be stopped halfway, check what it unpacked
+        total_size, nb_members = 0, 0
+        for path, is_dir in self.walk_files_dirs(extractor.extract_path):
+            nb_members += 1
+            if not is_dir:
+                total_size += path.lstat().st_size
+        extractor.check_budget(total_size, nb_members)
+
+    def _get_work_path(self, dst_path: Path) -> Path:
+        """Path in the work directory mirroring `dst_path` on the destination key."""
+        if self._work_root_path is None:
+            self._work_root_path = Path(tempfile.mkdtemp(prefix='filecheck_', dir=Config.archive_tmp_dir))
+            self.logger.add_root(self._work_root_path)
+        try:
+            return self._work_root_path / dst_path.relative_to(self.dst_root_path)
+        except ValueError:
+            return self._work_root_path / dst_path.name
+
+    def _remove_work_root(self):
+        if self._work_root_path is not None:
+            self.safe_rmtree(self._work_root_path)
+            self._work_root_path = None
+
+    def _extract_with_7z(self, archive_path: Path, tempdir_path: Path, timeout: Optional[float]=None) -> bool:
+        command_str = '{} -p1 x "{}" -o"{}" -bd -aoa'
+        # -p1=password, x=extract, -o=output location, -bd=no % indicator, -aoa=overwrite existing files
+        unpack_command = command_str.format(SEVENZ_PATH, archive_path, tempdir_path)
+        return self._run_process(unpack_command, timeout)
+
+    def _run_process(self, command_string: str, timeout: Optional[float]=None) -> bool:
         """Run command_string in a subprocess, wait until it finishes."""
         args = shlex.split(command_string)
         with open(self.logger.log_debug_err, 'ab') as stderr, open(self.logger.log_debug_out, 'ab') as stdout:
@@ -826,47 +2200,295 @@ class KittenGroomerFileCheck(KittenGroomerBase):
     def write_file_to_log(self, file: File):
         """Pass information about `file` to self.logger."""
         props = file.get_all_props()
-        if not file.is_archive:
-            # FIXME: in_tempdir is a hack to make image files appear at the correct tree depth in log
-            in_tempdir = file.tempdir_path.exists()
-            self.logger.add_file(file.src_path, props, in_tempdir)
+        # Archives are not logged, their content is, unless they were not unpacked
+        if not file.is_archive or file.is_dangerous:
+            self.logger.add_file(file.src_path, props)
+
+    def list_files_dirs(self, root_dir_path: Path) -> Iterator[Path]:
+        """
+        Yields all files and directories
+
+        Performs a depth-first traversal of the file tree, see walk_files_dirs.
+        """
+        for path, _ in self.walk_files_dirs(root_dir_path):
+            yield path
 
-    def list_files_dirs(self, root_dir_path: Path) -> List[Path]:
+    def walk_files_dirs(self, root_dir_path: Path) -> Iterator[Tuple[Path, bool]]:
         """
-        Returns a list of all files and directories
+        Yields a (path, is_directory) tuple for all files and directories
 
-        Performs a depth-first traversal of the file tree.
+        Performs a depth-first traversal of the file tree, sorting each
+        directory case-insensitively. Directories are only listed when the
+        traversal reaches them, using an explicit stack instead of recursion,
+        and the file types come from the cached os.DirEntry information.
+        Symlinks are never followed and are reported as files.
         """
         skipped_files = ('.Trashes', '._.Trashes', '.DS_Store', '.fseventsd', '.Spotlight-V100', 'System Volume Information')
-        queue = []
-        for path in sorted(os.listdir(root_dir_path), key=lambda x: str.lower(x)):
-            full_path = root_dir_path / path
-            filename = full_path.name
+        stack = [self._sorted_dir_entries(root_dir_path)]
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+                continue
+            filename = entry.name
             if filename not in skipped_files and not filename.startswith('._'):
                 # check for symlinks first to prevent getting trapped in infinite symlink recursion
-                if full_path.is_symlink():
-                    queue.append(full_path)
-                elif full_path.is_dir():
-                    # Skip hidden and special directories.
-                    queue.append(full_path)
-                    queue += self.list_files_dirs(full_path)
-                elif full_path.is_file():
-                    queue.append(full_path)
+                if entry.is_symlink():
+                    yield Path(entry.path), False
+                elif entry.is_dir():
+                    yield Path(entry.path), True
+                    stack.append(self._sorted_dir_entries(Path(entry.path)))
+                elif entry.is_file():
+                    yield Path(entry.path), False
             else:
                 print(f"SKIPPING: {filename}")
-        return queue
+
+    def _sorted_dir_entries(self, dir_path: Path) -> Iterator[os.DirEntry]:
+        with os.scandir(dir_path) as entries:
+            return iter(sorted(entries, key=lambda entry: entry.name.lower()))
+
+    def _worker_pool(self) -> ProcessPoolExecutor:
+        """Process pool checking the files, each worker with its own verdict cache and sandbox."""
+        # SQLite connections can't be shared with the workers, each one opens its own
+        cache_args = None
+        if self.verdict_cache is not None:
+            cache_args = (self.verdict_cache.db_path, self.verdict_cache.max_entries, self.verdict_cache.ruleset)
+        sandbox_args = None
+        if self.sandbox is not None:
+            sandbox_args = (self.handler_timeout, self.handler_max_memory)
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(cache_args, sandbox_args, Config.durability))
+
+    async def _run_pipeline(self, executor: Executor):
+        """
+        Process the source key with concurrent stages.
+
+        enumerate (a thread walking the source) -> check (libmagic, TOCTOU
+        samples and handlers, in `executor`) -> copy (threads writing to the
+        destination) -> log. The stages are connected by bounded queues of
+        futures consumed in order, so reading the source, analyzing and
+        writing the destination overlap while the log keeps the order of a
+        sequential run and the memory stays bounded by the queue depths.
+        Archives are unpacked, and their content processed, by the log stage
+        in its own thread.
+        """
+        loop = asyncio.get_running_loop()
+        to_check: asyncio.Queue = asyncio.Queue(Config.pipeline_queue_depth)
+        to_copy: asyncio.Queue = asyncio.Queue(Config.pipeline_queue_depth)
+        to_log: asyncio.Queue = asyncio.Queue(Config.pipeline_queue_depth)
+        with ThreadPoolExecutor(1, thread_name_prefix='filecheck_walk') as walk_pool, \
+                ThreadPoolExecutor(Config.pipeline_copy_threads, thread_name_prefix='filecheck_copy') as copy_pool, \
+                ThreadPoolExecutor(1, thread_name_prefix='filecheck_log') as log_pool:
+            tasks = [
+                asyncio.ensure_future(self._enumerate_stage(loop, walk_pool, to_check)),
+                asyncio.ensure_future(self._check_stage(loop, executor, to_check, to_copy)),
+                asyncio.ensure_future(self._copy_stage(loop, copy_pool, to_copy, to_log)),
+                asyncio.ensure_future(self._log_stage(loop, log_pool, to_log)),
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def _enumerate_batch(self, walker: Iterator[Tuple[Path, bool]]) -> List[Tuple[Path, bool, Optional[dict]]]:
+        """The next entries of `walker`, with the log properties of the files already groomed."""
+        return [(srcpath, is_dir, None if is_dir else self._journaled_props(srcpath))
+                for srcpath, is_dir in itertools.islice(walker, 64)]
+
+    async def _enumerate_stage(self, loop, pool: Executor, queue_out: asyncio.Queue):
+        walker = self.walk_files_dirs(self.src_root_path)
+        while True:
+            # The journal lookups can hash the files (Config.incremental_verify), out of the event loop
+            batch = await loop.run_in_executor(pool, self._enumerate_batch, walker)
+            if not batch:
+                break
+            for item in batch:
+                await queue_out.put(item)
+        await queue_out.put(None)
+
+    async def _check_stage(self, loop, executor: Executor, queue_in: asyncio.Queue, queue_out: asyncio.Queue):
+        timings = self.stage_timer is not None
+        while True:
+            item = await queue_in.get()
+            if item is None:
+                break
+            srcpath, is_dir, props = item
+            result: Union[asyncio.Future, dict, None] = props
+            if not is_dir and props is None:
+                result = loop.run_in_executor(executor, _check_path, srcpath, self._get_dst_path(srcpath), timings)
+            await queue_out.put((srcpath, result))
+        await queue_out.put(None)
+
+    async def _copy_stage(self, loop, pool: Executor, queue_in: asyncio.Queue, queue_out: asyncio.Queue):
+        while True:
+            item = await queue_in.get()
+            if item is None:
+                break
+            srcpath, result = item
+            if isinstance(result, asyncio.Future):
+                file = await result
+                result = loop.run_in_executor(pool, copy_checked_file, file)
+            await queue_out.put((srcpath, result))
+        await queue_out.put(None)
+
+    async def _log_stage(self, loop, pool: Executor, queue_in: asyncio.Queue):
+        while True:
+            item = await queue_in.get()
+            if item is None:
+                break
+            srcpath, result = item
+            if result is None:
+                self.logger.add_dir(srcpath)
+                continue
+            if isinstance(result, dict):
+                self.logger.add_file(srcpath, result)
+                continue
+            file = await result
+            if file.is_archive:
+                # Unpacking and processing the content takes a while, keep the loop running
+                await loop.run_in_executor(pool, self._finish_file, file)
+            else:
+                self._finish_file(file)
 
     def run(self):
-        self.process_dir(self.src_root_path)
+        forget_dirs()
+        try:
+            if self.pipeline:
+                with self._worker_pool() as executor:
+                    asyncio.run(self._run_pipeline(executor))
+            elif self.workers > 1:
+                with self._worker_pool() as executor:
+                    self._executor = executor
+                    try:
+                        self.process_dir(self.src_root_path)
+                    finally:
+                        self._executor = None
+            else:
+                self.process_dir(self.src_root_path)
+            if self.incremental and self.journal is not None:
+                for dst_path in self.journal.remove_vanished():
+                    print(f"REMOVED: {dst_path}")
+        finally:
+            self._remove_work_root()
+            self.logger.flush()
+            if Config.durability == 'final':
+                sync_filesystem(self.dst_root_path)
+            if self.stage_timer is not None:
+                with open(self.logger.log_path.parent / 'timings.txt', 'a') as timings_file:
+                    timings_file.write(self.stage_timer.summary())
+            if self.sandbox is not None:
+                self.sandbox.close()
+
+
+def make_file(src_path: Path, dst_path: Path, timings: bool=False) -> File:
+    """Create the File for `src_path`, with its timings enabled if `timings` is True."""
+    if not timings:
+        return File(src_path, dst_path)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    file = File(src_path, dst_path)
+    file.enable_timings()
+    file.add_timing('mimetype', time.perf_counter() - wall_start, time.process_time() - cpu_start)
+    return file
+
+
+def groom_file(file: File, verdict_cache: Optional[VerdictCache]=None,
+               sandbox: Optional[HandlerSandbox]=None) -> File:
+    """
+    Check `file` and copy it to the destination key if it should be copied.
+
+    Does not touch the logger, so it can run in a worker process.
+    """
+    file.check(verdict_cache, sandbox)
+    return copy_checked_file(file)
+
+
+def copy_checked_file(file: File) -> File:
+    """Copy `file`, once checked, to the destination key if it should be copied."""
+    if file.is_converted:
+        # Already written to the destination by its handler
+        file.set_property('copied', True)
+    elif not file.is_archive and file.should_copy:
+        if file.timed('copy', file.safe_copy):
+            file.set_property('copied', True)
+            if not file.timed('validate', file._validate_random_hashes):
+                # Something's fucked up.
+                copied_path = file.dst_path
+                file.make_dangerous('The copied file is different from the one checked, removing.')
+                copied_path.unlink()
+        else:
+            file.set_property('copied', False)
+    return file
+
+
+_worker_verdict_cache: Optional[VerdictCache] = None
+_worker_sandbox: Optional[HandlerSandbox] = None
+
+
+def _init_worker(cache_args: Optional[Tuple[Path, int, str]],
+                 sandbox_args: Optional[Tuple[Optional[float], Optional[int]]]=None,
+                 durability: Optional[str]=None):
+    """Initializer of the worker processes used by KittenGroomerFileCheck."""
+    global _worker_verdict_cache, _worker_sandbox
+    if durability is not None:
+        # Workers that are not forked don't see changes made to Config by the main process
+        Config.durability = durability
+    if cache_args is not None:
+        _worker_verdict_cache = VerdictCache(*cache_args)
+    if sandbox_args is not None:
+        _worker_sandbox = HandlerSandbox(*sandbox_args)
+
+
+def _check_path(src_path: Path, dst_path: Path, timings: bool=False) -> File:
+    """Entry point for the worker processes used by the pipeline of KittenGroomerFileCheck."""
+    file = make_file(src_path, dst_path, timings)
+    file.check(_worker_verdict_cache, _worker_sandbox)
+    return file
+
+
+def _groom_path(src_path: Path, dst_path: Path, timings: bool=False) -> File:
+    """Entry point for the worker processes used by KittenGroomerFileCheck."""
+    return groom_file(make_file(src_path, dst_path, timings), _worker_verdict_cache, _worker_sandbox)
 
 
 def main(kg_implementation, description: str):
     parser = argparse.ArgumentParser(prog='KittenGroomer', description=description)
     parser.add_argument('-s', '--source', type=str, help='Source directory')
     parser.add_argument('-d', '--destination', type=str, help='Destination directory')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes used to check and copy files')
+    parser.add_argument('--verdict-cache', type=str, default=None,
+                        help='Path of a database used to reuse the verdicts for files that were already checked')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Overlap reading the source, checking the files and writing the destination')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the files already groomed by an interrupted --resume run to the same destination')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process the files that changed since the last run to the same destination, '
+                             'and remove the ones that are not on the source anymore')
+    parser.add_argument('--durability', choices=('none', 'file', 'final'), default=None,
+                        help="When the destination is written to disk: left to the system (none), after each file "
+                             "(file) or once at the end (final, default)")
+    parser.add_argument('--log-format', type=str, default=None,
+                        help='Comma separated list of log files to write, among text, jsonl and csv (default: text)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Write the time spent in each processing stage to logs/timings.txt')
+    parser.add_argument('--handler-timeout', type=float, default=None,
+                        help='Seconds a file can be processed for before being marked dangerous')
+    parser.add_argument('--handler-memory', type=int, default=None,
+                        help='MiB of memory the worker running the handlers can allocate, on top of what it inherits '
+                             'from the groomer, before the file being processed is marked dangerous')
     args = parser.parse_args()
-    kg = kg_implementation(args.source, args.destination)
-    kg.run()
+    if args.durability is not None:
+        Config.durability = args.durability
+    handler_max_memory = args.handler_memory * 1024 * 1024 if args.handler_memory else None
+    log_formats = tuple(args.log_format.split(',')) if args.log_format else None
+    with kg_implementation(args.source, args.destination, workers=args.workers,
+                           verdict_cache_path=args.verdict_cache, handler_timeout=args.handler_timeout,
+                           handler_max_memory=handler_max_memory, timings=args.timings,
+                           log_formats=log_formats, pipeline=args.pipeline, resume=args.resume,
+                           incremental=args.incremental) as kg:
+        kg.run()
 
 
 if __name__ == '__main__':
@@ -9,16 +9,89 @@ your desired behavior.
 
 
 import os
+import ctypes
+import errno
 import hashlib
 import shutil
 import argparse
 import stat
+import sys
+import threading
 import traceback
 from pathlib import Path
-from typing import Union, Optional, List, Dict, Any, Tuple, Iterator
+from typing import Union, Optional, List, Dict, Any, Set, Tuple, Iterator, Sequence, Callable
 
 import magic  # type: ignore
 
+try:
+    import xxhash  # type: ignore
+except ImportError:
+    xxhash = None
+
+
+COPY_BUFFER_SIZE = 0x100000
+# Hash functions that can be selected by name, see new_hash. sha256 and
+# blake2b are cryptographic, the xxh* ones are only available if xxhash is
+# installed and are meant for integrity checks where speed matters.
+HASH_ALGORITHMS: Dict[str, Callable[[], Any]] = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS.update({
+        'xxh64': xxhash.xxh64,
+        'xxh3_64': xxhash.xxh3_64,
+        'xxh3_128': xxhash.xxh3_128,
+    })
+# Used for the digests of whole files (logs, verdict cache)
+DIGEST_ALGORITHM = 'sha256'
+# Amount of data libmagic looks at by default: a buffer at least that long
+# gives the same result as the file it was read from.
+MAGIC_HEADER_SIZE = 0x100000
+# Largest amount of data handed to copy_file_range or sendfile in one call
+KERNEL_COPY_CHUNK_SIZE = 0x40000000
+
+
+class MimeTypeDetector(object):
+    """
+    Determine mimetypes with libmagic.
+
+    Keeps one magic.Magic handle per thread (and so per worker process)
+    instead of going through python-magic's shared default instance, and
+    can detect the mimetype from data that was already read.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def _magic(self) -> magic.Magic:
+        handle = getattr(self._local, 'magic', None)
+        if handle is None:
+            handle = magic.Magic(mime=True)
+            self._local.magic = handle
+        return handle
+
+    def from_file(self, file_path: Union[str, Path]) -> str:
+        """Return the mimetype of the file at `file_path`."""
+        return self._magic.from_file(str(file_path))
+
+    def from_buffer(self, buffer: bytes) -> str:
+        """
+        Return the mimetype of a file from its first bytes.
+
+        `buffer` should hold the whole file or at least its first
+        MAGIC_HEADER_SIZE bytes. An empty buffer is reported as an empty
+        file, like from_file does.
+        """
+        if not buffer:
+            return 'inode/x-empty'
+        return self._magic.from_buffer(bytes(buffer[:MAGIC_HEADER_SIZE]))
+
+
+mimetype_detector = MimeTypeDetector()
+
 
 class FileBase(object):
     """
@@ -44,6 +117,11 @@ class FileBase(object):
         self._errors: Dict[Exception, str] = {}
         self._user_defined: Dict[str, str] = {}
         self.should_copy: bool = True
+        self.src_sha256: Optional[str] = None  # hash of the source, set when it is read in full (see safe_copy)
+        self.dst_sha256: Optional[str] = None  # hash of what was written to the destination
+        self.copied_samples: Dict[int, bytes] = {}  # set by safe_copy
+        self.copied_bytes: int = 0  # set by safe_copy
+        self.header: Optional[bytes] = None  # whole content of the small files, read once for libmagic
         self.mimetype = self._determine_mimetype(str(src_path))
 
     @property
@@ -58,6 +136,11 @@ class FileBase(object):
         else:
             return ext.lower()
 
+    @property
+    def sha256(self) -> Optional[str]:
+        """Hash of the file on the destination if it was written, of the source if known, else None."""
+        return self.dst_sha256 or self.src_sha256
+
     @property
     def maintype(self) -> Optional[str]:
         main, _ = self._split_mimetype(self.mimetype)
@@ -148,6 +231,9 @@ class FileBase(object):
             'is_symlink': self.is_symlink,
             'symlink_path': self.symlink_path,
             'copied': self.copied,
+            'sha256': self.sha256,
+            'src_sha256': self.src_sha256,
+            'dst_sha256': self.dst_sha256,
             'description_string': self.description_string,
             'errors': self._errors,
             'user_defined': self._user_defined
@@ -183,17 +269,20 @@ class FileBase(object):
         """
         Copy file and create destination directories if needed.
 
-        Sets all exec bits to '0'.
+        The file is read only once: the sha256 of the copied bytes is stored
+        in self.src_sha256 and self.dst_sha256 and the blocks returned by
+        _copy_sample_ranges are stored in self.copied_samples. If _zero_copy
+        is True, the data is copied by the kernel and not hashed. Sets all
+        exec bits to '0'.
         """
         src = self.src_path
         dst = self.dst_path
         try:
-            self.dst_dir.mkdir(exist_ok=True, parents=True)
-            shutil.copy(src, dst)
-            current_perms = self._get_file_permissions(dst)
-            only_exec_bits = 0o0111
-            perms_no_exec = current_perms & (~only_exec_bits)
-            dst.chmod(perms_no_exec)
+            make_dirs(self.dst_dir)
+            algorithm = None if self._zero_copy() else DIGEST_ALGORITHM
+            digest, self.copied_samples, self.copied_bytes = copy_file(src, dst, self._copy_sample_ranges(), algorithm,
+                                                                       self._fsync_copy())
+            self.src_sha256 = self.dst_sha256 = digest
             return True
         except IOError as e:
             # Probably means we can't write in the dest dir
@@ -201,6 +290,18 @@ class FileBase(object):
             traceback.print_exc()
             return False
 
+    def _copy_sample_ranges(self) -> List[Tuple[int, int]]:
+        """(start, length) of the blocks safe_copy should keep from the copied bytes."""
+        return []
+
+    def _zero_copy(self) -> bool:
+        """True if safe_copy can leave the copy to the kernel, without computing the sha256 of the file."""
+        return False
+
+    def _fsync_copy(self) -> bool:
+        """True if safe_copy should wait for the copy to be on disk."""
+        return False
+
     def force_ext(self, extension: str):
         """If dst_path does not end in `extension`, append .ext to it."""
         new_ext = self._check_leading_dot(extension)
@@ -221,7 +322,7 @@ class FileBase(object):
             if Path(f'{self.src_path}{ext}').exists():
                 raise KittenGroomerError(f'Could not create metadata file for "{self.filename}": a file with that path exists.')
             else:
-                self.dst_dir.mkdir(exist_ok=True, parents=True)
+                make_dirs(self.dst_dir)
                 # TODO: shouldn't mutate state and also return something
                 self.metadata_file_path = Path(f'{self.dst_path}{ext}')
                 return self.metadata_file_path
@@ -244,9 +345,34 @@ class FileBase(object):
             self.set_property('symlink_path', os.readlink(file_path))
         else:
             # libmagic always returns something, even if it's just 'data'
-            mimetype = magic.from_file(file_path, mime=True)
+            self.header = self._read_header(file_path)
+            if self.header is not None:
+                mimetype = mimetype_detector.from_buffer(self.header)
+            else:
+                mimetype = mimetype_detector.from_file(file_path)
         return mimetype
 
+    def _read_header(self, file_path: str) -> Optional[bytes]:
+        """
+        The content of the file if it fits in MAGIC_HEADER_SIZE bytes, else None.
+
+        libmagic gives the same result for the whole content as for the
+        file, and the content can be reused instead of being read again
+        (see filecheck's random hashes). Larger files are left to libmagic,
+        some of its tests look at the end of the file.
+        """
+        if self.size > MAGIC_HEADER_SIZE or not os.path.isfile(file_path):
+            return None
+        try:
+            with open(file_path, 'rb') as f:
+                header = f.read(MAGIC_HEADER_SIZE + 1)
+        except OSError:
+            return None
+        if len(header) > MAGIC_HEADER_SIZE:
+            # Grew since its size was read
+            return None
+        return header
+
     def _split_mimetype(self, mimetype: str) -> Tuple[Union[str, None], Union[str, None]]:
         main_type, sub_type = None, None
         if mimetype and '/' in mimetype:
@@ -271,19 +397,333 @@ class FileBase(object):
         return stat.S_IMODE(full_mode)
 
 
+def new_hash(algorithm: str=DIGEST_ALGORITHM):
+    """Return a new hash object for `algorithm`, one of the keys of HASH_ALGORITHMS."""
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise KittenGroomerError(f'Unknown or unavailable hash algorithm: {algorithm}')
+
+
+_buffers = threading.local()
+
+
+def _copy_buffer() -> Tuple[bytearray, memoryview]:
+    """Buffer of COPY_BUFFER_SIZE bytes reused by the reads of the current thread, and a view on it."""
+    try:
+        return _buffers.buffer, _buffers.view
+    except AttributeError:
+        _buffers.buffer = bytearray(COPY_BUFFER_SIZE)
+        _buffers.view = memoryview(_buffers.buffer)
+        return _buffers.buffer, _buffers.view
+
+
+def hash_file(path: Path, algorithm: str=DIGEST_ALGORITHM) -> str:
+    """
+    Return the hexdigest of the file at `path` with `algorithm`.
+
+    The file is read with readinto in a buffer reused across calls. hashlib
+    releases the GIL while hashing buffers of that size, so files can be
+    hashed in parallel threads.
+    """
+    s = new_hash(algorithm)
+    buf, view = _copy_buffer()
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            length = f.readinto(buf)
+            if not length:
+                break
+            s.update(view[:length])
+    return s.hexdigest()
+
+
+def copy_file(src_path: Path, dst_path: Path,
+              sample_ranges: Sequence[Tuple[int, int]]=(),
+              algorithm: Optional[str]=DIGEST_ALGORITHM,
+              fsync: bool=False) -> Tuple[Optional[str], Dict[int, bytes], int]:
+    """
+    Copy `src_path` to `dst_path`, with the permissions of the source minus the exec bits.
+
+    Returns the hexdigest of the copied data with `algorithm`, a dict
+    mapping the start of each (start, length) block in `sample_ranges` to
+    the bytes that were copied at that position, and the number of bytes
+    copied. The data goes through a buffer reused across calls and is
+    hashed in the same pass. If `algorithm` is None, the data is not
+    hashed and is copied by the kernel with copy_file_range or sendfile
+    when the filesystems support it: the digest is None and the sampled
+    blocks are read back from the destination. With `fsync`, returns once
+    the copy is on disk.
+    """
+    ranges = dict(sample_ranges)  # the same block can be sampled more than once
+    with open(src_path, 'rb', buffering=0) as fsrc, \
+            open(os.open(dst_path, os.O_RDWR | os.O_CREAT, 0o666), 'r+b', buffering=0) as fdst:
+        # Compare the open files rather than probing the destination path first
+        src_stat = os.fstat(fsrc.fileno())
+        dst_stat = os.fstat(fdst.fileno())
+        if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+            raise shutil.SameFileError(f'{src_path} and {dst_path} are the same file')
+        if dst_stat.st_size:
+            fdst.truncate(0)
+        copied = None
+        if algorithm is None:
+            copied = _kernel_copy(fsrc.fileno(), fdst.fileno())
+        if copied is None:
+            digest, samples, copied = _buffered_copy(fsrc, fdst, ranges, algorithm)
+        else:
+            digest = None
+            samples = {start: os.pread(fdst.fileno(), length, start) for start, length in ranges.items()}
+        os.fchmod(fdst.fileno(), stat.S_IMODE(src_stat.st_mode) & ~0o111)
+        if fsync:
+            os.fsync(fdst.fileno())
+    return digest, samples, copied
+
+
+# Destination directories known to exist, see make_dirs
+_created_dirs: Set[str] = set()
+
+
+def make_dirs(dir_path: Path):
+    """
+    Create `dir_path` and its missing parents with Path.mkdir(parents=True, exist_ok=True).
+
+    The directories created or found are remembered, so each of them costs
+    one mkdir per process until forget_dirs is called, instead of one per
+    file copied in it. Slow metadata operations add up on FAT and exFAT
+    keys.
+    """
+    if str(dir_path) in _created_dirs:
+        return
+    dir_path.mkdir(parents=True, exist_ok=True)
+    _created_dirs.add(str(dir_path))
+    _created_dirs.update(str(parent) for parent in dir_path.parents)
+
+
+def forget_dirs():
+    """Forget the directories created by make_dirs, at the start of a run."""
+    _created_dirs.clear()
+
+
+try:
+    _syncfs: Optional[Callable[[int], int]] = ctypes.CDLL(None, use_errno=True).syncfs
+except (AttributeError, OSError):
+    # Linux only
+    _syncfs = None
+
+
+def sync_filesystem(path: Path):
+    """Wait for everything written to the filesystem holding `path` to be on disk (syncfs, or sync)."""
+    if _syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), str(path))
+    finally:
+        os.close(fd)
+
+
+def _buffered_copy(fsrc, fdst, ranges: Dict[int, int],
+                   algorithm: Optional[str]) -> Tuple[Optional[str], Dict[int, bytes], int]:
+    s = new_hash(algorithm) if algorithm is not None else None
+    samples = {start: bytearray() for start in ranges}
+    buf, view = _copy_buffer()
+    offset = 0
+    while True:
+        length = fsrc.readinto(buf)
+        if not length:
+            break
+        data = view[:length]
+        written = 0
+        while written < length:
+            written += fdst.write(data[written:])
+        if s is not None:
+            s.update(data)
+        end = offset + length
+        for start, sample_length in ranges.items():
+            if start < end and start + sample_length > offset:
+                samples[start] += data[max(start - offset, 0):start + sample_length - offset]
+        offset = end
+    digest = s.hexdigest() if s is not None else None
+    return digest, {start: bytes(block) for start, block in samples.items()}, offset
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, KERNEL_COPY_CHUNK_SIZE, offset, offset)
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int) -> int:
+    return os.sendfile(dst_fd, src_fd, offset, KERNEL_COPY_CHUNK_SIZE)
+
+
+# Tried in order by _kernel_copy, depending on what the platform provides
+_KERNEL_COPY_METHODS: List[Callable[[int, int, int], int]] = []
+if hasattr(os, 'copy_file_range'):
+    _KERNEL_COPY_METHODS.append(_copy_file_range)
+if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+    # Only Linux can sendfile from a file to a file
+    _KERNEL_COPY_METHODS.append(_sendfile)
+
+
+def _kernel_copy(src_fd: int, dst_fd: int) -> Optional[int]:
+    """
+    Copy the content of `src_fd` to `dst_fd` without going through userspace.
+
+    Returns the number of bytes copied, or None if neither copy_file_range
+    nor sendfile work for these files and nothing was written.
+    """
+    src_size = os.fstat(src_fd).st_size
+    for method in _KERNEL_COPY_METHODS:
+        copied = 0
+        try:
+            while True:
+                length = method(src_fd, dst_fd, copied)
+                if not length:
+                    break
+                copied += length
+        except OSError as e:
+            # Not supported by the kernel or these filesystems (e.g. across them with older kernels)
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                         errno.ENOTSUP, errno.EBADF, errno.EPERM):
+                raise
+            continue
+        # Some filesystems (e.g. FUSE or procfs) report a size but copy nothing this way
+        if copied or not src_size:
+            return copied
+    return None
+
+
+class HashingWriter(object):
+    """
+    Writable file object computing the sha256 of the data written to `path`.
+
+    Meant to be handed to writers that produce a file in one pass, such as
+    PIL's Image.save. If the writer seeks back to rewrite part of the file,
+    the hash is computed by reading the file again once it is closed.
+    """
+
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self._file = open(path, 'wb')
+        self._hash = new_hash()
+        self._position = 0
+        self._end = 0
+        self._sequential = True
+
+    def write(self, data) -> int:
+        if self._position != self._end:
+            self._sequential = False
+        written = self._file.write(data)
+        if self._sequential:
+            self._hash.update(data)
+        self._position += written
+        self._end = max(self._end, self._position)
+        return written
+
+    def seek(self, offset: int, whence: int=os.SEEK_SET) -> int:
+        self._position = self._file.seek(offset, whence)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def hexdigest(self) -> str:
+        """sha256 of the file, call once it is closed."""
+        if self._sequential:
+            return self._hash.hexdigest()
+        return hash_file(self.path)
+
+
+class HashingReader(object):
+    """
+    Readable file object computing the sha256 of the whole file at `path`.
+
+    Meant to be handed to readers that go through a file mostly in order,
+    such as PIL's Image.open. The data is hashed as it is read; the parts
+    the reader skips, and the end of the file it did not read, are read by
+    the HashingReader itself when needed, so each byte is hashed once.
+    """
+
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self._file = open(path, 'rb')
+        self._hash = new_hash()
+        self._hashed = 0  # the data before that offset was hashed
+
+    def _catch_up(self, position: int):
+        """Hash the data between what was already hashed and `position`."""
+        if position <= self._hashed:
+            return
+        current = self._file.tell()
+        self._file.seek(self._hashed)
+        while self._hashed < position:
+            buf = self._file.read(min(COPY_BUFFER_SIZE, position - self._hashed))
+            if not buf:
+                break
+            self._hash.update(buf)
+            self._hashed += len(buf)
+        self._file.seek(current)
+
+    def _hash_read(self, position: int, data: bytes):
+        end = position + len(data)
+        if end > self._hashed:
+            self._hash.update(memoryview(data)[self._hashed - position:])
+            self._hashed = end
+
+    def read(self, size: Optional[int]=-1) -> bytes:
+        position = self._file.tell()
+        self._catch_up(position)
+        data = self._file.read(size)
+        self._hash_read(position, data)
+        return data
+
+    def readline(self, size: Optional[int]=-1) -> bytes:
+        position = self._file.tell()
+        self._catch_up(position)
+        data = self._file.readline(size)
+        self._hash_read(position, data)
+        return data
+
+    def seek(self, offset: int, whence: int=os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def hexdigest(self) -> str:
+        """sha256 of the whole file, call before it is closed."""
+        self._catch_up(os.fstat(self._file.fileno()).st_size)
+        return self._hash.hexdigest()
+
+
 class Logging(object):
 
     @staticmethod
     def computehash(path: Path) -> str:
         """Return the sha256 hash of a file at a given path."""
-        s = hashlib.sha256()
-        with path.open('rb') as f:
-            while True:
-                buf = f.read(0x100000)
-                if not buf:
-                    break
-                s.update(buf)
-        return s.hexdigest()
+        return hash_file(path)
 
 
 class KittenGroomerBase(object):
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import gzip
+import hashlib
 import os
+import tarfile
+import zipfile
 from pathlib import Path
+import unittest.mock as mock
 
 import pytest  # type: ignore
 import yaml
 
 try:
-    from filecheck.filecheck import KittenGroomerFileCheck, File
+    from filecheck.filecheck import (KittenGroomerFileCheck, File, GroomerLogger, VerdictCache,
+                                     ArchiveExtractor, ArchiveBudgetExceeded, Config, HandlerSandbox,
+                                     Ruleset, MetadataWriter, ProgressJournal, make_file,
+                                     ruleset_version)
     NODEPS = False
 except ImportError:
     NODEPS = True
@@ -127,3 +135,672 @@ def test_uncategorized(tmpdir):
     dst_path = tmpdir.strpath
     groomer = KittenGroomerFileCheck(src_path, dst_path, debug=True)
     groomer.run()
+
+
+def test_parallel_run_log_matches_sequential(tmp_path):
+    src_path = os.path.abspath('tests/logging/')
+    sequential = KittenGroomerFileCheck(src_path, tmp_path / 'sequential')
+    sequential.run()
+    parallel = KittenGroomerFileCheck(src_path, tmp_path / 'parallel', workers=2)
+    parallel.run()
+    assert parallel.logger.log_path.read_bytes() == sequential.logger.log_path.read_bytes()
+
+
+def test_pipeline_run_matches_sequential(tmp_path):
+    src_path = os.path.abspath('tests/logging/')
+    sequential = KittenGroomerFileCheck(src_path, tmp_path / 'sequential')
+    sequential.run()
+    pipeline = KittenGroomerFileCheck(src_path, tmp_path / 'pipeline', workers=2, pipeline=True)
+    pipeline.run()
+    assert pipeline.logger.log_path.read_bytes() == sequential.logger.log_path.read_bytes()
+    copied = sorted(path.relative_to(tmp_path / 'sequential') for path in (tmp_path / 'sequential').rglob('*'))
+    assert copied == sorted(path.relative_to(tmp_path / 'pipeline') for path in (tmp_path / 'pipeline').rglob('*'))
+
+
+def _make_resume_source(src_path):
+    (src_path / 'sub').mkdir(parents=True)
+    for name in ('a.txt', 'b.txt', 'sub/c.txt'):
+        (src_path / name).write_text(name * 100)
+    (src_path / 'link').symlink_to('a.txt')
+
+
+@parametrize('workers, pipeline', [(1, False), (2, False), (2, True)])
+def test_resume_skips_groomed_files(tmp_path, workers, pipeline):
+    src_path = tmp_path / 'src'
+    _make_resume_source(src_path)
+    first = KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True)
+    first.run()
+    first.close()
+    log = first.logger.log_path.read_bytes()
+    (src_path / 'b.txt').write_text('changed')
+    with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file, \
+            mock.patch.object(ProgressJournal, 'completed', autospec=True,
+                              side_effect=ProgressJournal.completed) as mock_completed:
+        with KittenGroomerFileCheck(src_path, tmp_path / 'dst', workers=workers, pipeline=pipeline,
+                                    resume=True) as resumed:
+            resumed.run()
+    # Each file is looked up once in the journal
+    assert sorted(call.args[1].name for call in mock_completed.call_args_list) == ['a.txt', 'b.txt', 'c.txt', 'link']
+    if workers == 1:
+        assert [call.args[0].name for call in mock_make_file.call_args_list] == ['b.txt']
+    assert (tmp_path / 'dst' / 'b.txt').read_text() == 'changed'
+    # Only the line of b.txt changed in the log
+    resumed_log = resumed.logger.log_path.read_bytes()
+    assert [line for line in resumed_log.splitlines() if b'b.txt' not in line] == \
+        [line for line in log.splitlines() if b'b.txt' not in line]
+    assert b'b.txt' in resumed_log
+
+
+def test_resume_processes_missing_copies(tmp_path):
+    src_path = tmp_path / 'src'
+    _make_resume_source(src_path)
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True) as first:
+        first.run()
+    (tmp_path / 'dst' / 'sub' / 'c.txt').unlink()
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True) as resumed:
+        resumed.run()
+    assert (tmp_path / 'dst' / 'sub' / 'c.txt').read_text() == 'sub/c.txt' * 100
+
+
+def test_resume_after_ruleset_change(tmp_path):
+    src_path = tmp_path / 'src'
+    _make_resume_source(src_path)
+    with mock.patch.object(Config, 'malicious_exts', Config.malicious_exts + ('.doc',)):
+        with KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True) as first:
+            first.run()
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True) as second:
+        assert not second.journal.reusable
+        second.run()
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True) as third:
+        assert third.journal.reusable
+        with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file:
+            third.run()
+    assert mock_make_file.call_count == 0
+
+
+def test_no_journal_without_resume(tmp_path):
+    src_path = tmp_path / 'src'
+    _make_resume_source(src_path)
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst') as first:
+        assert first.journal is None
+        first.run()
+    assert not (first.logger.log_path.parent / ProgressJournal.filename).exists()
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', resume=True) as second:
+        assert second.journal.entries == {}
+        with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file:
+            second.run()
+    assert mock_make_file.call_count == 4
+
+
+def test_incremental_removes_vanished_files(tmp_path):
+    src_path = tmp_path / 'src'
+    _make_resume_source(src_path)
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as first:
+        first.run()
+    (src_path / 'sub' / 'c.txt').unlink()
+    (src_path / 'sub').rmdir()
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as second:
+        with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file:
+            second.run()
+    assert mock_make_file.call_count == 0
+    assert not (tmp_path / 'dst' / 'sub').exists()
+    assert (tmp_path / 'dst' / 'a.txt').exists()
+    assert sorted(second.journal.entries) == ['a.txt', 'b.txt', 'link']
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as third:
+        assert sorted(third.journal.entries) == ['a.txt', 'b.txt', 'link']
+
+
+def test_incremental_removes_vanished_archive_content(tmp_path):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    (src_path / 'a.txt').write_text('a' * 100)
+    with zipfile.ZipFile(src_path / 'archive.zip', 'w') as archive:
+        archive.writestr('m.txt', 'member')
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as first:
+        first.run()
+    assert (tmp_path / 'dst' / 'archive.zip' / 'm.txt').read_text() == 'member'
+    (src_path / 'archive.zip').unlink()
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as second:
+        second.run()
+    assert sorted(os.listdir(tmp_path / 'dst')) == ['a.txt', 'logs']
+    assert sorted(second.journal.entries) == ['a.txt']
+
+
+def test_incremental_detects_replaced_files(tmp_path):
+    src_path = tmp_path / 'src'
+    _make_resume_source(src_path)
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as first:
+        first.run()
+    # Same size and mtime, new inode
+    stat = os.stat(src_path / 'a.txt')
+    (src_path / 'new.txt').write_text('A' * stat.st_size)
+    os.utime(src_path / 'new.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(src_path / 'new.txt', src_path / 'a.txt')
+    # Same size, mtime and inode, only found by hashing the content again
+    stat = os.stat(src_path / 'b.txt')
+    (src_path / 'b.txt').write_text('B' * stat.st_size)
+    os.utime(src_path / 'b.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as second:
+        with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file:
+            second.run()
+    assert [call.args[0].name for call in mock_make_file.call_args_list] == ['a.txt']
+    assert (tmp_path / 'dst' / 'a.txt').read_text() == 'A' * stat.st_size
+    with mock.patch.object(Config, 'incremental_verify', True):
+        with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as third:
+            assert third.journal.reusable
+            with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file:
+                third.run()
+    # The copy of the link still has the content a.txt had in the first run
+    assert [call.args[0].name for call in mock_make_file.call_args_list] == ['b.txt', 'link']
+    assert (tmp_path / 'dst' / 'b.txt').read_text() == 'B' * stat.st_size
+    with mock.patch.object(Config, 'incremental_verify', True):
+        with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as fourth:
+            with mock.patch('filecheck.filecheck.make_file', side_effect=make_file) as mock_make_file:
+                fourth.run()
+    assert mock_make_file.call_count == 0
+
+
+def test_incremental_removes_renamed_copy(tmp_path):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    (src_path / 'a.txt').write_text('a' * 100)
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as first:
+        first.run()
+    (src_path / 'a.txt').write_bytes(b'\x7fELF\x02\x01\x01' + b'\0' * 200)
+    with KittenGroomerFileCheck(src_path, tmp_path / 'dst', incremental=True) as second:
+        second.run()
+    assert sorted(os.listdir(tmp_path / 'dst')) == ['DANGEROUS_a.txt_DANGEROUS', 'logs']
+
+
+def test_random_hashes_detect_source_change(tmp_path):
+    src_path = tmp_path / 'data.txt'
+    src_path.write_bytes(b'a' * 4096)
+    file = File(src_path, tmp_path / 'dst' / 'data.txt')
+    file._compute_random_hashes()
+    src_path.write_bytes(b'b' * 4096)
+    file.safe_copy()
+    assert not file._validate_random_hashes()
+
+
+def test_zero_copy_validates_samples(tmp_path):
+    src_path = tmp_path / 'data.txt'
+    src_path.write_bytes(b'text ' * 1000)
+    file = File(src_path, tmp_path / 'dst' / 'data.txt')
+    file._compute_random_hashes()
+    with mock.patch.object(Config, 'zero_copy_maintypes', ('text',)), \
+            mock.patch.object(Config, 'zero_copy_min_size', 0):
+        assert file.safe_copy()
+    assert file.sha256 is None
+    assert file.copied_bytes == 5000
+    assert file._validate_random_hashes()
+
+
+def test_random_hashes_validate_copy(tmp_path):
+    src_path = tmp_path / 'data.txt'
+    src_path.write_bytes(os.urandom(4096))
+    file = File(src_path, tmp_path / 'dst' / 'data.txt')
+    file._compute_random_hashes()
+    file.safe_copy()
+    assert file._validate_random_hashes()
+
+
+@parametrize('from_config', [False, True])
+def test_logger_flush_policy(tmp_path, from_config):
+    if from_config:
+        with mock.patch.object(Config, 'log_flush_lines', 2), mock.patch.object(Config, 'log_flush_interval', 3600):
+            logger = GroomerLogger(tmp_path / 'src', tmp_path / 'dst')
+    else:
+        logger = GroomerLogger(tmp_path / 'src', tmp_path / 'dst', flush_lines=2, flush_interval=3600)
+    header = logger.log_path.read_bytes()
+    logger.add_dir(tmp_path / 'src' / 'first')
+    assert logger.log_path.read_bytes() == header
+    logger.add_dir(tmp_path / 'src' / 'second')
+    assert logger.log_path.read_bytes().endswith(b'second/\n')
+    logger.add_dir(tmp_path / 'src' / 'third')
+    logger.close()
+    assert logger.log_path.read_bytes().endswith(b'third/\n')
+
+
+def test_groomer_context_manager_closes_log(tmp_path):
+    with KittenGroomerFileCheck(os.path.abspath('tests/logging/'), tmp_path) as groomer:
+        groomer.run()
+    assert groomer.logger.sinks[0]._log_file.closed
+    assert b'test.conf' in groomer.logger.log_path.read_bytes()
+
+
+def test_list_files_dirs_order(tmp_path):
+    src_path = tmp_path / 'src'
+    for path in ('b/z.txt', 'B2/a.txt', 'a.txt', 'C/d/e.txt', '.DS_Store'):
+        (src_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (src_path / path).write_text('test')
+    (src_path / 'link').symlink_to(src_path / 'b')
+    groomer = KittenGroomerFileCheck(src_path, tmp_path / 'dst')
+    paths = [str(path.relative_to(src_path)) for path in groomer.list_files_dirs(src_path)]
+    assert paths == ['a.txt', 'b', 'b/z.txt', 'B2', 'B2/a.txt', 'C', 'C/d', 'C/d/e.txt', 'link']
+
+
+def test_verdict_cache_hit_skips_handlers(tmp_path):
+    cache = VerdictCache(tmp_path / 'cache.sqlite')
+    first = File(NORMAL_FILES_PATH / 'pdf-sample.pdf', tmp_path / 'first' / 'pdf-sample.pdf')
+    first.check(cache)
+    second = File(NORMAL_FILES_PATH / 'pdf-sample.pdf', tmp_path / 'second' / 'pdf-sample.pdf')
+    with mock.patch.object(File, '_pdf') as mock_pdf:
+        second.check(cache)
+    mock_pdf.assert_not_called()
+    assert second.is_dangerous == first.is_dangerous
+    assert second.description_string == first.description_string
+    assert second.filename == first.filename
+
+
+def test_verdict_cache_dangerous_verdict(tmp_path):
+    cache = VerdictCache(tmp_path / 'cache.sqlite')
+    src_path = tmp_path / 'data.bin'
+    src_path.write_bytes(os.urandom(1024))
+    first = File(src_path, tmp_path / 'first' / 'data.bin')
+    first.check(cache)
+    assert first.is_dangerous
+    second = File(src_path, tmp_path / 'second' / 'data.bin')
+    second.check(cache)
+    assert second.is_dangerous
+    assert second.filename == first.filename
+    assert second.description_string == first.description_string
+
+
+@parametrize('names', [('a.text', 'b.txt'), ('b.txt', 'a.text')])
+def test_verdict_cache_replays_forced_extension(tmp_path, names):
+    cache = VerdictCache(tmp_path / 'cache.sqlite')
+    for name in names:
+        (tmp_path / name).write_text('Same text content\n')
+        file = File(tmp_path / name, tmp_path / 'dst' / name)
+        file.check(cache)
+        assert file.filename == (name if name.endswith('.txt') else name + '.txt')
+    assert file.checked_sha256 is not None
+
+
+def test_verdict_cache_invalidated_by_ruleset(tmp_path):
+    cache = VerdictCache(tmp_path / 'cache.sqlite', ruleset='old')
+    cache.put('0' * 64, 'text/plain', {'is_dangerous': False})
+    cache.close()
+    cache = VerdictCache(tmp_path / 'cache.sqlite', ruleset='new')
+    assert cache.get('0' * 64, 'text/plain') is None
+
+
+def test_ruleset_version_ignores_operational_settings():
+    version = ruleset_version()
+    with mock.patch.object(Config, 'durability', 'none'), \
+            mock.patch.object(Config, 'incremental_verify', True), \
+            mock.patch.object(Config, 'log_formats', ('jsonl',)):
+        assert ruleset_version() == version
+    with mock.patch.object(Config, 'malicious_exts', Config.malicious_exts + ('.txt',)):
+        assert ruleset_version() != version
+    with mock.patch.object(Config, 'exif_max_tags', 10):
+        assert ruleset_version() != version
+
+
+@parametrize('from_config', [False, True])
+def test_verdict_cache_eviction(tmp_path, from_config):
+    if from_config:
+        with mock.patch.object(Config, 'verdict_cache_max_entries', 2):
+            cache = VerdictCache(tmp_path / 'cache.sqlite')
+    else:
+        cache = VerdictCache(tmp_path / 'cache.sqlite', max_entries=2)
+    for i in range(3):
+        cache.put(str(i), 'text/plain', {'index': i})
+    assert cache.get('0', 'text/plain') is None
+    assert cache.get('2', 'text/plain') == {'index': 2}
+
+
+def test_archive_extractor_tar_gz(tmp_path):
+    member_path = tmp_path / 'member.txt'
+    member_path.write_text('test')
+    archive_path = tmp_path / 'archive.tar.gz'
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        archive.add(member_path, arcname='dir/member.txt')
+        archive.add(member_path, arcname='../escaped.txt')
+    extractor = ArchiveExtractor(archive_path, tmp_path / 'out', 'gzip')
+    assert extractor.is_supported
+    extractor.extract()
+    assert (tmp_path / 'out' / 'dir' / 'member.txt').read_text() == 'test'
+    assert not (tmp_path / 'escaped.txt').exists()
+
+
+@parametrize('member_name', ['link/pwned.txt', 'link'])
+def test_archive_extractor_tar_symlink_not_followed(tmp_path, member_name):
+    outside_path = tmp_path / 'outside'
+    outside_path.mkdir()
+    (outside_path / 'target.txt').write_text('target')
+    member_path = tmp_path / 'member.txt'
+    member_path.write_text('pwned')
+    archive_path = tmp_path / 'archive.tar'
+    with tarfile.open(archive_path, 'w') as archive:
+        link = tarfile.TarInfo('link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = str(outside_path / 'target.txt' if member_name == 'link' else outside_path)
+        archive.addfile(link)
+        archive.add(member_path, arcname=member_name)
+    extractor = ArchiveExtractor(archive_path, tmp_path / 'out', 'x-tar')
+    extractor.extract()
+    assert (tmp_path / 'out' / 'link').is_symlink()
+    assert sorted(path.name for path in outside_path.iterdir()) == ['target.txt']
+    assert (outside_path / 'target.txt').read_text() == 'target'
+
+
+def test_archive_extractor_gzip_stream(tmp_path):
+    archive_path = tmp_path / 'data.txt.gz'
+    with gzip.open(archive_path, 'wb') as f:
+        f.write(b'test')
+    ArchiveExtractor(archive_path, tmp_path / 'out', 'gzip').extract()
+    assert (tmp_path / 'out' / 'data.txt').read_bytes() == b'test'
+
+
+def test_zip_archive_unpacked_outside_destination(tmp_path):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    with zipfile.ZipFile(src_path / 'archive.zip', 'w') as archive:
+        archive.writestr('dir/member.txt', 'test')
+    dst_path = tmp_path / 'dst'
+    with KittenGroomerFileCheck(src_path, dst_path) as groomer:
+        with mock.patch('filecheck.filecheck.KittenGroomerFileCheck._run_process') as mock_run:
+            groomer.run()
+        mock_run.assert_not_called()
+    assert (dst_path / 'archive.zip' / 'member.txt').read_text() == 'test'
+    assert not (dst_path / 'archive.zip_temp').exists()
+    assert groomer._work_root_path is None
+
+
+def test_archive_extractor_size_budget_from_headers(tmp_path):
+    archive_path = tmp_path / 'bomb.zip'
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('zeros.txt', b'\0' * (4 * 1024 * 1024))
+    extractor = ArchiveExtractor(archive_path, tmp_path / 'out', 'zip', max_size=1024 * 1024)
+    with pytest.raises(ArchiveBudgetExceeded):
+        extractor.extract()
+    assert not (tmp_path / 'out' / 'zeros.txt').exists()
+
+
+def test_archive_extractor_ratio_budget_while_streaming(tmp_path):
+    archive_path = tmp_path / 'bomb.tar.gz'
+    member_path = tmp_path / 'zeros.txt'
+    member_path.write_bytes(b'\0' * (4 * 1024 * 1024))
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        archive.add(member_path, arcname='zeros.txt')
+    extractor = ArchiveExtractor(archive_path, tmp_path / 'out', 'gzip', max_ratio=10)
+    with pytest.raises(ArchiveBudgetExceeded):
+        extractor.extract()
+    assert extractor.total_size < 4 * 1024 * 1024
+
+
+def test_archive_over_budget_marked_dangerous(tmp_path):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    with zipfile.ZipFile(src_path / 'archive.zip', 'w') as archive:
+        for i in range(5):
+            archive.writestr(f'member_{i}.txt', 'test')
+    dst_path = tmp_path / 'dst'
+    groomer = KittenGroomerFileCheck(src_path, dst_path)
+    file = File(src_path / 'archive.zip', dst_path / 'archive.zip')
+    with mock.patch.object(Config, 'archive_max_members', 2):
+        groomer.process_file(file)
+    assert file.is_dangerous
+    assert not (dst_path / 'archive.zip').exists()
+    groomer.close()
+    assert b'Archive bomb' in groomer.logger.log_path.read_bytes()
+
+
+def _slow_text(file):
+    if file.filename.startswith('slow'):
+        import time
+        time.sleep(30)
+    file.add_description('Text file')
+
+
+def _broken_text(file):
+    raise ValueError('broken parser')
+
+
+def _allocating_text(self):
+    self.add_description(f'Allocated {len(bytearray(16 * 1024 * 1024))} bytes')
+
+
+def test_sandbox_timeout_marks_dangerous(tmp_path):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    (src_path / 'slow.txt').write_text('slow')
+    (src_path / 'fast.txt').write_text('fast')
+    dst_path = tmp_path / 'dst'
+    sandbox = HandlerSandbox(timeout=1)
+    with mock.patch.object(File, 'text', _slow_text):
+        slow_file = File(src_path / 'slow.txt', dst_path / 'slow.txt')
+        slow_file.check(sandbox=sandbox)
+        fast_file = File(src_path / 'fast.txt', dst_path / 'fast.txt')
+        fast_file.check(sandbox=sandbox)
+    sandbox.close()
+    assert slow_file.is_dangerous
+    assert 'Processing timed out' in slow_file.description_string
+    assert not fast_file.is_dangerous
+    assert 'Text file' in fast_file.description_string
+
+
+def test_sandbox_exception_marks_dangerous(tmp_path):
+    (tmp_path / 'file.txt').write_text('text')
+    sandbox = HandlerSandbox(timeout=10)
+    with mock.patch.object(File, 'text', _broken_text):
+        file = File(tmp_path / 'file.txt', tmp_path / 'dst' / 'file.txt')
+        file.check(sandbox=sandbox)
+    sandbox.close()
+    assert file.is_dangerous
+    assert 'Processing failed' in file.description_string
+
+
+def test_sandbox_memory_limit_on_top_of_inherited(tmp_path):
+    (tmp_path / 'file.txt').write_text('text')
+    # Less than the address space the worker inherits from the test process
+    sandbox = HandlerSandbox(max_memory=64 * 1024 * 1024)
+    with mock.patch.object(File, 'text', _allocating_text):
+        file = File(tmp_path / 'file.txt', tmp_path / 'dst' / 'file.txt')
+        file.check(sandbox=sandbox)
+    sandbox.close()
+    assert not file.is_dangerous
+    assert 'Allocated' in file.description_string
+
+
+def test_ruleset_partial_matches():
+    ruleset = Ruleset()
+    assert ruleset.app_method('vnd.openxmlformats-officedocument.wordprocessingml.document') == '_ooxml'
+    assert ruleset.app_method('x-rar') == '_archive'
+    assert ruleset.app_method('x-unknown-thing') is None
+    assert ruleset.text_kind('rtf') == 'rtf'
+    assert ruleset.text_kind('csv') == 'csv'
+    assert ruleset.text_kind('plain') is None
+    assert '.exe' in ruleset.malicious_exts
+    with mock.patch.object(Config, 'malicious_exts', ('.txt',)):
+        assert '.txt' in Ruleset().malicious_exts
+
+
+def test_ruleset_follows_config_changes(tmp_path):
+    (tmp_path / 'a.txt').write_text('text')
+
+    def check_txt():
+        file = File(tmp_path / 'a.txt', tmp_path / 'dst' / 'a.txt')
+        file.check()
+        return file
+
+    assert not check_txt().is_dangerous
+    with mock.patch.object(Config, 'malicious_exts', Config.malicious_exts + ('.txt',)):
+        assert check_txt().is_dangerous
+    with mock.patch.dict(Config.aliases, {'text/plain': 'application/pdf'}):
+        assert check_txt().is_dangerous
+    assert not check_txt().is_dangerous
+
+
+def test_ruleset_extension_index_matches_mimetypes():
+    import mimetypes
+    ruleset = Ruleset()
+    names = [f'file{ext}' for ext in list(mimetypes.types_map) + list(mimetypes.common_types)]
+    names += ['FILE.PDF', 'archive.tar.bz2', 'archive.tgz', 'file.unknownext', 'file.Z', 'data:text/x,y.txt']
+    for name in names:
+        expected_mimetype, encoding = mimetypes.guess_type(name, strict=False)
+        expected_mimetypes, indexed_encoding = ruleset.expected_mimetypes(Path(name))
+        assert expected_mimetypes[0] == expected_mimetype
+        assert indexed_encoding == encoding
+    for mimetype in set(mimetypes.types_map.values()) | set(Config.aliases):
+        alias = Config.aliases.get(mimetype, mimetype)
+        expected = mimetypes.guess_all_extensions(alias, strict=False)
+        if alias in Config.aliases:
+            expected += mimetypes.guess_all_extensions(Config.aliases[alias], strict=False)
+        assert ruleset.expected_extensions(mimetype) == expected
+
+
+def test_ruleset_list_aliases():
+    with mock.patch.dict(Config.aliases, {'x/y': ['text/plain', 'application/pdf']}):
+        ruleset = Ruleset()
+        extensions = ruleset.expected_extensions('x/y')
+    assert '.txt' in extensions
+    assert '.pdf' in extensions
+
+
+def test_image_written_to_destination(tmp_path):
+    from PIL import Image
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    Image.new('RGB', (64, 1000), (255, 0, 0)).save(src_path / 'image.png')
+    dst_path = tmp_path / 'dst'
+    groomer = KittenGroomerFileCheck(src_path, dst_path)
+    file = File(src_path / 'image.png', dst_path / 'image.png')
+    groomer.process_file(file)
+    groomer.close()
+    assert file.is_converted and not file.is_dangerous
+    assert file.src_path == src_path / 'image.png'
+    assert sorted(os.listdir(dst_path)) == ['image.png', 'logs']
+    with Image.open(dst_path / 'image.png') as img:
+        assert img.size == (64, 1000)
+        assert img.getpixel((10, 999)) == (255, 0, 0)
+    assert file.sha256 == hashlib.sha256((dst_path / 'image.png').read_bytes()).hexdigest()
+    assert file.src_sha256 == hashlib.sha256((src_path / 'image.png').read_bytes()).hexdigest()
+
+
+def test_image_over_memory_budget(tmp_path):
+    from PIL import Image
+    Image.new('RGB', (100, 100)).save(tmp_path / 'image.png')
+    file = File(tmp_path / 'image.png', tmp_path / 'dst' / 'image.png')
+    with mock.patch.object(Config, 'image_max_memory', 10000):
+        file.check()
+    assert file.is_dangerous
+    assert not file.is_converted
+    assert not (tmp_path / 'dst' / 'image.png').exists()
+
+
+def test_metadata_png_all_tags(tmp_path):
+    from PIL import Image, PngImagePlugin
+    png_info = PngImagePlugin.PngInfo()
+    png_info.add_text('Author', 'someone')
+    png_info.add_text('Comment', 'something')
+    Image.new('RGB', (10, 10)).save(tmp_path / 'image.png', pnginfo=png_info)
+    file = File(tmp_path / 'image.png', tmp_path / 'dst' / 'image.png')
+    file.check()
+    lines = (tmp_path / 'dst' / 'image.png.metadata.txt').read_text().splitlines()
+    assert 'Key: Author\tValue: someone' in lines
+    assert 'Key: Comment\tValue: something' in lines
+
+
+def test_metadata_writer_jsonl(tmp_path):
+    import json
+    with MetadataWriter(tmp_path / 'file.metadata.jsonl', 'jsonl') as metadata_file:
+        metadata_file.write_tag('Image Make', 'Camera')
+        metadata_file.write_tag('Image Model', 'X')
+    lines = (tmp_path / 'file.metadata.jsonl').read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [{'key': 'Image Make', 'value': 'Camera'},
+                                                    {'key': 'Image Model', 'value': 'X'}]
+    with MetadataWriter(tmp_path / 'empty.metadata.txt') as metadata_file:
+        pass
+    assert not (tmp_path / 'empty.metadata.txt').exists()
+
+
+def _jpeg_with_exif(path):
+    from PIL import Image
+    exif = Image.Exif()
+    exif[0x010f] = 'Camera maker'  # Make
+    exif[0x0110] = 'Camera model'  # Model
+    Image.new('RGB', (10, 10)).save(path, exif=exif)
+
+
+def test_metadata_exif(tmp_path):
+    _jpeg_with_exif(tmp_path / 'image.jpg')
+    file = File(tmp_path / 'image.jpg', tmp_path / 'dst' / 'image.jpg')
+    file.check()
+    assert not file.is_dangerous
+    lines = (tmp_path / 'dst' / 'image.jpg.metadata.txt').read_text().splitlines()
+    assert 'Key: Image Make\tValue: Camera maker' in lines
+    assert 'Key: Image Model\tValue: Camera model' in lines
+
+
+@pytest.mark.parametrize('budget', [('exif_max_bytes', 16), ('exif_max_tags', 1)])
+def test_metadata_exif_over_budget(tmp_path, budget):
+    _jpeg_with_exif(tmp_path / 'image.jpg')
+    file = File(tmp_path / 'image.jpg', tmp_path / 'dst' / 'image.jpg')
+    with mock.patch.object(Config, *budget):
+        file.check()
+    assert file.is_dangerous
+    assert 'EXIF metadata over budget' in file.description_string
+    assert not (tmp_path / 'dst' / 'image.jpg.metadata.txt').exists()
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_timing_hooks(tmp_path, workers):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    (src_path / 'file.txt').write_text('text')
+    with zipfile.ZipFile(src_path / 'archive.zip', 'w') as archive:
+        archive.writestr('member.txt', 'test')
+    dst_path = tmp_path / 'dst'
+    recorded = []
+    with KittenGroomerFileCheck(src_path, dst_path, workers=workers) as groomer:
+        groomer.add_timing_hook(lambda file, stage, wall, cpu: recorded.append((file.filename, stage)))
+        groomer.run()
+    assert {'mimetype', 'checks', 'random_hashes', 'handler', 'copy', 'validate'} <= \
+        {stage for filename, stage in recorded if filename == 'file.txt'}
+    assert ('archive.zip', 'unpack') in recorded
+    assert ('member.txt', 'copy') in recorded
+    summary = (dst_path / 'logs' / 'timings.txt').read_text()
+    assert 'text/plain: handler' in summary
+    assert 'copy: 8 bytes' in summary
+
+
+def test_structured_log_sinks(tmp_path):
+    import csv
+    import json
+    src_path = tmp_path / 'src'
+    (src_path / 'dir').mkdir(parents=True)
+    (src_path / 'dir' / 'file.txt').write_text('text')
+    (src_path / 'script.exe').write_text('text')
+    dst_path = tmp_path / 'dst'
+    with KittenGroomerFileCheck(src_path, dst_path, log_formats=('text', 'jsonl', 'csv')) as groomer:
+        groomer.run()
+    logs_path = dst_path / 'logs'
+    assert b'file.txt' in (logs_path / 'circlean_log.txt').read_bytes()
+    records = [json.loads(line) for line in (logs_path / 'circlean_log.jsonl').read_text().splitlines()]
+    assert [(record['type'], record.get('path')) for record in records] == [
+        ('root', str(src_path)), ('dir', 'dir'), ('file', os.path.join('dir', 'file.txt')), ('file', 'script.exe')]
+    text_file = records[2]
+    assert text_file['sha256'] == hashlib.sha256(b'text').hexdigest()
+    assert text_file['copied'] and not text_file['is_dangerous']
+    assert records[3]['is_dangerous']
+    with open(logs_path / 'circlean_log.csv', newline='') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert [row['type'] for row in rows] == ['root', 'dir', 'file', 'file']
+    assert rows[2]['sha256'] == text_file['sha256']
+    assert rows[3]['is_dangerous'] == 'True'
+
+
+def test_hashes_not_recomputed_for_log(tmp_path):
+    src_path = tmp_path / 'src'
+    src_path.mkdir()
+    (src_path / 'file.txt').write_text('text')
+    (src_path / 'empty.txt').write_text('')
+    dst_path = tmp_path / 'dst'
+    with mock.patch('kittengroomer.helpers.Logging.computehash', side_effect=AssertionError('file hashed again')):
+        with KittenGroomerFileCheck(src_path, dst_path) as groomer:
+            groomer.run()
+    log = groomer.logger.log_path.read_text()
+    assert '+- NOT COPIED: empty.txt (------)' in log
+    assert 'file.txt ({})'.format(hashlib.sha256(b'text').hexdigest()[:6]) in log
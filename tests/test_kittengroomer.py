@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import errno
 import os
+import hashlib
+import shutil
+import stat
 from pathlib import Path
 import unittest.mock as mock
 
 import pytest  # type: ignore
 
-from kittengroomer import FileBase, KittenGroomerBase
-from kittengroomer.helpers import ImplementationRequired
+from kittengroomer import FileBase, KittenGroomerBase, MimeTypeDetector
+from kittengroomer.helpers import (ImplementationRequired, HashingReader, HashingWriter, COPY_BUFFER_SIZE,
+                                   MAGIC_HEADER_SIZE, HASH_ALGORITHMS, KittenGroomerError, hash_file, new_hash,
+                                   copy_file, _buffered_copy, _KERNEL_COPY_METHODS, forget_dirs, make_dirs,
+                                   sync_filesystem)
 
 skip = pytest.mark.skip
 xfail = pytest.mark.xfail
@@ -41,7 +48,7 @@ class TestFileBase:
     @fixture
     def text_file(self, tmpfile_path, dest_dir_path):
         with mock.patch(
-            'kittengroomer.helpers.magic.from_file',
+            'kittengroomer.helpers.MimeTypeDetector.from_buffer',
             return_value='text/plain'
         ):
             dst_path = dest_dir_path / 'test.txt'
@@ -50,7 +57,7 @@ class TestFileBase:
 
     # Constructor behavior
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_init_identify_filename(self, mock_libmagic):
         """Init should identify the filename correctly for src_path."""
         src_path = Path('src/test.txt')
@@ -58,7 +65,7 @@ class TestFileBase:
         file = FileBase(src_path, dst_path)
         assert file.filename == 'test.txt'
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_init_identify_extension(self, mock_libmagic):
         """Init should identify the extension for src_path."""
         src_path = Path('src/test.txt')
@@ -66,7 +73,7 @@ class TestFileBase:
         file = FileBase(src_path, dst_path)
         assert file.extension == '.txt'
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_init_uppercase_extension(self, mock_libmagic):
         """Init should coerce uppercase extension to lowercase"""
         src_path = Path('src/test.txt')
@@ -74,7 +81,7 @@ class TestFileBase:
         file = FileBase(src_path, dst_path)
         assert file.extension == '.txt'
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_has_extension_true(self, mock_libmagic):
         """If the file has an extension, has_extension should == True."""
         src_path = Path('src/test.txt')
@@ -82,7 +89,7 @@ class TestFileBase:
         file = FileBase(src_path, dst_path)
         assert file.has_extension is True
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_has_extension_false(self, mock_libmagic):
         """If the file has no extension, has_extensions should == False."""
         src_path = Path('src/test')
@@ -100,13 +107,13 @@ class TestFileBase:
         with pytest.raises(IsADirectoryError):
             FileBase(Path(tmpdir.strpath), Path(tmpdir.strpath))
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_init_symlink(self, mock_libmagic, symlink_file_path, tmpdir):
         """Init should properly identify symlinks."""
         file = FileBase(symlink_file_path, Path(tmpdir.strpath))
         assert file.mimetype == 'inode/symlink'
 
-    @mock.patch('kittengroomer.helpers.magic')
+    @mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file')
     def test_is_symlink_attribute(self, mock_libmagic, symlink_file_path, tmpdir):
         """If a file is a symlink, is_symlink should return True."""
         file = FileBase(symlink_file_path, Path(tmpdir.strpath))
@@ -115,7 +122,7 @@ class TestFileBase:
     def test_init_mimetype_attribute_assigned_correctly(self):
         """When libmagic returns a given mimetype, the mimetype should be
         assigned properly."""
-        with mock.patch('kittengroomer.helpers.magic.from_file',
+        with mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file',
                         return_value='text/plain'):
             file = FileBase(Path('non_existent'), Path('non_existent'))
         assert file.mimetype == 'text/plain'
@@ -123,7 +130,7 @@ class TestFileBase:
     def test_maintype_and_subtype_attributes(self):
         """If a file has a full mimetype, maintype and subtype should ==
         the appropriate values."""
-        with mock.patch('kittengroomer.helpers.magic.from_file',
+        with mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file',
                         return_value='text/plain'):
             file = FileBase(Path('non_existent'), Path('non_existent'))
         assert file.maintype == 'text'
@@ -131,7 +138,7 @@ class TestFileBase:
 
     def test_has_mimetype_no_full_type(self):
         """If a file doesn't have a full mimetype has_mimetype should == False."""
-        with mock.patch('kittengroomer.helpers.magic.from_file',
+        with mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file',
                         return_value='data'):
             file = FileBase(Path('non_existent'), Path('non_existent'))
         assert file.has_mimetype is False
@@ -242,24 +249,165 @@ class TestFileBase:
         assert text_file.extension == '.txt'
         assert '.txt.txt' not in text_file.dst_path.name
 
-    def test_safe_copy_calls_copy(self, src_dir_path, dest_dir_path):
+    def test_safe_copy_copies_and_hashes(self, src_dir_path, dest_dir_path):
         """Calling safe_copy should copy the file from the correct path to
-        the correct destination path."""
+        the correct destination path and record the hash of the copied data."""
         file_path = src_dir_path / 'test.txt'
         with open(file_path, 'w+') as file:
-            file.write('')
+            file.write('testing')
         dst_path = dest_dir_path / 'test.txt'
-        with mock.patch('kittengroomer.helpers.magic.from_file',
+        with mock.patch('kittengroomer.helpers.MimeTypeDetector.from_buffer',
                         return_value='text/plain'):
             file = FileBase(file_path, dst_path)
-        with mock.patch('kittengroomer.helpers.shutil.copy') as mock_copy:
-            file.safe_copy()
-            mock_copy.assert_called_once_with(file_path, dst_path)
-
-    def test_safe_copy_removes_exec_perms(self):
+        assert file.safe_copy() is True
+        assert dst_path.read_bytes() == b'testing'
+        assert file.sha256 == hashlib.sha256(b'testing').hexdigest()
+
+    def test_copy_file_samples(self, src_dir_path, dest_dir_path):
+        """copy_file should return the copied bytes for each sampled block,
+        including blocks spanning two reads."""
+        file_path = src_dir_path / 'samples.bin'
+        data = os.urandom(COPY_BUFFER_SIZE + 100)
+        file_path.write_bytes(data)
+        start = COPY_BUFFER_SIZE - 10
+        digest, samples, _ = copy_file(file_path, dest_dir_path / 'samples.bin',
+                                       [(0, 16), (start, 32)])
+        assert digest == hashlib.sha256(data).hexdigest()
+        assert samples == {0: data[:16], start: data[start:start + 32]}
+
+    def test_hashing_writer(self, dest_dir_path):
+        """HashingWriter should hash what was written, even if the writer seeks back."""
+        with HashingWriter(dest_dir_path / 'sequential.bin') as writer:
+            writer.write(b'test')
+            writer.write(b'ing')
+        assert writer.hexdigest() == hashlib.sha256(b'testing').hexdigest()
+        with HashingWriter(dest_dir_path / 'rewritten.bin') as writer:
+            writer.write(b'xxxxing')
+            writer.seek(0)
+            writer.write(b'test')
+        assert writer.hexdigest() == hashlib.sha256(b'testing').hexdigest()
+
+    def test_hashing_reader(self, src_dir_path):
+        """HashingReader should hash the whole file, including the parts that were skipped or not read."""
+        file_path = src_dir_path / 'read.bin'
+        data = os.urandom(3 * COPY_BUFFER_SIZE)
+        file_path.write_bytes(data)
+        with HashingReader(file_path) as reader:
+            assert reader.read(100) == data[:100]
+            reader.seek(COPY_BUFFER_SIZE)
+            assert reader.read(10) == data[COPY_BUFFER_SIZE:COPY_BUFFER_SIZE + 10]
+            reader.seek(50)
+            assert reader.read(100) == data[50:150]
+            assert reader.hexdigest() == hashlib.sha256(data).hexdigest()
+
+    @pytest.mark.parametrize('algorithm', sorted(HASH_ALGORITHMS))
+    def test_hash_file(self, src_dir_path, algorithm):
+        """hash_file should give the same digest as hashing the whole content at once."""
+        file_path = src_dir_path / 'hashed.bin'
+        data = os.urandom(COPY_BUFFER_SIZE + 100)
+        file_path.write_bytes(data)
+        expected = new_hash(algorithm)
+        expected.update(data)
+        assert hash_file(file_path, algorithm) == expected.hexdigest()
+        digest, _, _ = copy_file(file_path, src_dir_path / 'hashed.copy', algorithm=algorithm)
+        assert digest == expected.hexdigest()
+
+    def test_make_dirs_creates_each_directory_once(self, dest_dir_path):
+        """make_dirs should create missing parents and not touch the filesystem again for known directories."""
+        forget_dirs()
+        with mock.patch('os.mkdir', side_effect=os.mkdir) as mkdir:
+            make_dirs(dest_dir_path / 'a' / 'b')
+            make_dirs(dest_dir_path / 'a' / 'b')
+            make_dirs(dest_dir_path / 'a')
+        assert (dest_dir_path / 'a' / 'b').is_dir()
+        assert mkdir.call_count == 3  # a/b (missing parent), a, a/b again, then only the cache
+        (dest_dir_path / 'file').touch()
+        with pytest.raises(FileExistsError):
+            make_dirs(dest_dir_path / 'file')
+
+    def test_make_dirs_created_concurrently(self, dest_dir_path):
+        """make_dirs should not fail if another worker creates the directory while its parents are created."""
+        forget_dirs()
+        dir_path = dest_dir_path / 'c' / 'd'
+        mkdir = os.mkdir
+        calls = []
+
+        def racing_mkdir(path, *args):
+            calls.append(str(path))
+            if calls.count(str(dir_path)) == 2:
+                mkdir(path)  # by another worker, after the parent was created
+            mkdir(path, *args)
+
+        with mock.patch('os.mkdir', side_effect=racing_mkdir):
+            make_dirs(dir_path)
+        assert dir_path.is_dir()
+
+    def test_copy_file_same_file(self, src_dir_path):
+        file_path = src_dir_path / 'same.txt'
+        file_path.write_text('same')
+        with pytest.raises(shutil.SameFileError):
+            copy_file(file_path, file_path)
+        assert file_path.read_text() == 'same'
+
+    def test_copy_file_fsync_replaces_content(self, src_dir_path, dest_dir_path):
+        file_path = src_dir_path / 'short.txt'
+        file_path.write_text('short')
+        (dest_dir_path / 'short.txt').write_text('much longer content')
+        with mock.patch('os.fsync') as fsync:
+            copy_file(file_path, dest_dir_path / 'short.txt', fsync=True)
+        assert fsync.called
+        assert (dest_dir_path / 'short.txt').read_text() == 'short'
+        sync_filesystem(dest_dir_path)
+
+    def test_new_hash_unknown_algorithm(self):
+        with pytest.raises(KittenGroomerError):
+            new_hash('md4-but-faster')
+
+    def test_safe_copy_removes_exec_perms(self, src_dir_path, dest_dir_path):
         """`safe_copy` should create a file that doesn't have any of the
         executable bits set."""
-        pass
+        file_path = src_dir_path / 'script.sh'
+        file_path.write_text('#!/bin/sh')
+        file_path.chmod(0o754)
+        with mock.patch('kittengroomer.helpers.MimeTypeDetector.from_buffer',
+                        return_value='text/x-shellscript'):
+            file = FileBase(file_path, dest_dir_path / 'script.sh')
+        assert file.safe_copy() is True
+        assert stat.S_IMODE((dest_dir_path / 'script.sh').stat().st_mode) == 0o644
+
+    @pytest.mark.parametrize('kernel_copy', ['native', 'unsupported', 'copies_nothing'])
+    def test_copy_file_without_hash(self, src_dir_path, dest_dir_path, kernel_copy):
+        """copy_file without an algorithm should copy in the kernel if it can, else in userspace,
+        and read the sampled blocks back from the destination."""
+        file_path = src_dir_path / 'video.bin'
+        data = os.urandom(COPY_BUFFER_SIZE + 100)
+        file_path.write_bytes(data)
+
+        def unsupported(src_fd, dst_fd, offset):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        def copies_nothing(src_fd, dst_fd, offset):
+            return 0
+
+        methods = {'native': _KERNEL_COPY_METHODS, 'unsupported': [unsupported],
+                   'copies_nothing': [copies_nothing]}[kernel_copy]
+        with mock.patch('kittengroomer.helpers._KERNEL_COPY_METHODS', methods), \
+                mock.patch('kittengroomer.helpers._buffered_copy', side_effect=_buffered_copy) as buffered:
+            digest, samples, copied = copy_file(file_path, dest_dir_path / 'video.bin', [(10, 16)], None)
+        assert buffered.called != (kernel_copy == 'native' and bool(_KERNEL_COPY_METHODS))
+        assert digest is None
+        assert copied == len(data)
+        assert samples == {10: data[10:26]}
+        assert (dest_dir_path / 'video.bin').read_bytes() == data
+
+    def test_copy_file_without_hash_empty_source(self, src_dir_path, dest_dir_path):
+        """An empty source should be copied by the kernel without falling back to userspace."""
+        file_path = src_dir_path / 'empty.bin'
+        file_path.write_bytes(b'')
+        with mock.patch('kittengroomer.helpers._buffered_copy', side_effect=_buffered_copy) as buffered:
+            digest, samples, copied = copy_file(file_path, dest_dir_path / 'empty.bin', algorithm=None)
+        assert buffered.called != bool(_KERNEL_COPY_METHODS)
+        assert (digest, samples, copied) == (None, {}, 0)
 
     def test_safe_copy_makedir_doesnt_exist(self):
         """Calling safe_copy should create intermediate directories in the path
@@ -278,6 +426,41 @@ class TestFileBase:
         pass
 
 
+class TestMimeTypeDetector:
+
+    @fixture
+    def detector(self):
+        return MimeTypeDetector()
+
+    def test_from_buffer_matches_from_file(self, detector):
+        """Detecting from the first bytes of a file should give the same
+        result as detecting from its path."""
+        for path in Path('tests/normal').iterdir():
+            with path.open('rb') as f:
+                header = f.read(MAGIC_HEADER_SIZE)
+            assert detector.from_buffer(header) == detector.from_file(path)
+
+    def test_from_buffer_empty(self, detector, tmp_path):
+        """An empty buffer should be detected like an empty file."""
+        empty_path = tmp_path / 'empty'
+        empty_path.touch()
+        assert detector.from_buffer(b'') == detector.from_file(empty_path)
+
+    def test_small_files_detected_from_their_content(self, tmp_path):
+        """FileBase should read small files once and detect their mimetype from that content."""
+        small_path = tmp_path / 'small.txt'
+        small_path.write_text('small')
+        with mock.patch('kittengroomer.helpers.MimeTypeDetector.from_file') as from_file:
+            file = FileBase(small_path, tmp_path / 'dst.txt')
+        assert not from_file.called
+        assert file.mimetype == 'text/plain'
+        assert file.header == b'small'
+        with mock.patch('kittengroomer.helpers.MAGIC_HEADER_SIZE', 2):
+            file = FileBase(small_path, tmp_path / 'dst.txt')
+        assert file.mimetype == 'text/plain'
+        assert file.header is None
+
+
 class TestLogging:
 
     def test_computehash(self):